@@ -0,0 +1,249 @@
+"""Load test of the bot handlers against local stand-ins.
+
+Simulated users go through the whole conversation of ``bot.main``, from
+/start to the search result, with Telegram answered in process, a mock
+Skyscanner server on localhost, fakeredis (or ``--redis-url``) and SQLite
+in place of Postgres. Reports the latency percentiles of an update, the
+throughput and the redis, http and database calls per update.
+
+    python -m benchmarks.load --users 2000 --concurrency 16 --latency 50
+    python -m benchmarks.load --save-baseline baseline.json
+    python -m benchmarks.load --baseline baseline.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import stubs
+
+
+# Metrics where a higher value is a regression, the rest are throughput.
+LOWER_IS_BETTER = ('p50_ms', 'p95_ms', 'p99_ms', 'telegram_per_update',
+                   'http_per_update', 'redis_per_update', 'db_per_update')
+
+
+def percentile(values, q: float):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def setup_environment(args, skyscanner):
+    """Point the bot at the stand-ins, must run before importing it."""
+    os.environ['SKYSCANNER_API_URL'] = skyscanner.url
+    os.environ.setdefault('SKYSCANNER_TOKEN', 'bench' * 8)
+    os.environ.setdefault('TOKEN', '1:bench')
+
+    if args.redis_url:
+        os.environ['REDIS_URL'] = args.redis_url
+        return
+
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit('Install fakeredis or pass --redis-url')
+
+    import redis
+    server = fakeredis.FakeServer()
+    redis.StrictRedis.from_url = classmethod(
+        lambda cls, *a, **kw: fakeredis.FakeStrictRedis(server=server),
+    )
+    os.environ.setdefault('REDIS_URL', 'redis://localhost:6379/15')
+
+
+def setup_database(counter):
+    import peewee
+    from bot.utils import init_db, BotUser, Channel
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    database = peewee.SqliteDatabase(path, check_same_thread=False)
+    init_db(database)
+    database.create_tables([BotUser, Channel])
+    stubs.count_queries(database, counter)
+    return database
+
+
+class Conversation:
+    """Texts a user sends to get from /start to the search result."""
+
+    def __init__(self, geo: dict, routes: int, seed: int=0):
+        rng = random.Random(seed)
+        countries = geo['Continents'][0]['Countries']
+        start = datetime.date.today() + datetime.timedelta(days=30)
+        self.routes = []
+        for _ in range(routes):
+            country = rng.choice(countries)
+            place_to = rng.choice(rng.choice(countries)['Cities'])
+            date_from = start + datetime.timedelta(days=rng.randrange(60))
+            date_to = date_from + datetime.timedelta(days=rng.randint(1, 14))
+            self.routes.append([
+                '/start',
+                country['Name'],
+                rng.choice(country['Cities'])['Name'],
+                place_to['Name'],
+                date_from.strftime('%d.%m.%Y'),
+                date_to.strftime('%d.%m.%Y'),
+            ])
+
+    def texts(self, user_id: int):
+        return self.routes[user_id % len(self.routes)]
+
+
+def make_update(update_id: int, user_id: int, text: str):
+    from telebot import types
+
+    return types.Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Bench'},
+            'text': text,
+        },
+    })
+
+
+def run(args):
+    skyscanner = stubs.MockSkyscanner(
+        latency=args.latency / 1000,
+        quotes=args.quotes,
+        fixtures=stubs.load_fixtures(args.fixtures) if args.fixtures else None,
+    ).start()
+    setup_environment(args, skyscanner)
+
+    telegram = stubs.FakeTelegram()
+    telegram.install()
+    redis_calls = stubs.CallCounter()
+    stubs.count_redis(redis_calls)
+    db_calls = stubs.CallCounter()
+    setup_database(db_calls)
+
+    from bot.main import bot
+    from bot.utils import api
+    from bot.writes import writes
+
+    bot.threaded = False
+    api.geo.ensure_loaded()
+    conversation = Conversation(
+        skyscanner.fixtures.get('geo', skyscanner.geo), args.routes,
+    )
+
+    for counter in (skyscanner.counter, telegram.counter, redis_calls,
+                    db_calls):
+        counter.reset()
+
+    latencies = []
+    lock = threading.Lock()
+    update_ids = iter(range(1, 1 << 62))
+
+    def simulate(user_id):
+        timings = []
+        for text in conversation.texts(user_id):
+            with lock:
+                update = make_update(next(update_ids), user_id, text)
+            started = time.perf_counter()
+            bot.process_new_updates([update])
+            timings.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(timings)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        list(executor.map(simulate, range(1, args.users + 1)))
+    elapsed = time.perf_counter() - started
+    # The write-behind queue is part of the cost of the updates.
+    writes.flush()
+
+    updates = len(latencies)
+    return {
+        'users': args.users,
+        'updates': updates,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'updates_per_sec': updates / elapsed,
+        'telegram_per_update': telegram.counter.total() / updates,
+        'http_per_update': skyscanner.counter.total() / updates,
+        'redis_per_update': redis_calls.total() / updates,
+        'db_per_update': db_calls.total() / updates,
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float):
+    """Names of the metrics worse than the baseline by over ``tolerance``."""
+    regressions = []
+    for name, base in baseline.items():
+        if name not in result or not isinstance(base, (int, float)):
+            continue
+        value = result[name]
+        if name in LOWER_IS_BETTER:
+            # Tiny call counts get an absolute slack of 0.01 per update.
+            worse = value > base * (1 + tolerance) + 0.01
+        elif name == 'updates_per_sec':
+            worse = value < base * (1 - tolerance)
+        else:
+            continue
+        if worse:
+            regressions.append(name)
+    return regressions
+
+
+def report(result: dict, baseline: dict=None):
+    for name, value in result.items():
+        line = '{:<22}{:>12.2f}'.format(name, value)
+        if baseline and name in baseline:
+            line += '{:>12.2f}'.format(baseline[name])
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--routes', type=int, default=200,
+                        help='distinct searches, lower means more cache hits')
+    parser.add_argument('--latency', type=float, default=50,
+                        help='mean Skyscanner latency, ms')
+    parser.add_argument('--quotes', type=int, default=60,
+                        help='quotes per browsequotes response')
+    parser.add_argument('--fixtures',
+                        help='directory with recorded geo.json and '
+                             'browsequotes.json')
+    parser.add_argument('--redis-url',
+                        help='real redis to use instead of fakeredis, '
+                             'it is not cleaned up')
+    parser.add_argument('--save-baseline', metavar='PATH')
+    parser.add_argument('--baseline', metavar='PATH')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    result = run(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(result, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    if baseline:
+        regressions = compare(result, baseline, args.tolerance)
+        if regressions:
+            print('Regressed: {}'.format(', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
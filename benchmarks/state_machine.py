@@ -0,0 +1,132 @@
+"""Micro-benchmark of the session state machine.
+
+Compares a ``transitions.Machine`` built per instance (the previous
+implementation of ``User``) with the shared ``StateMachine`` table.
+``--check`` fires every trigger from every state on both and exits with 1
+when they disagree, it needs ``pip install transitions``.
+
+    python -m benchmarks.state_machine
+    python -m benchmarks.state_machine --check
+"""
+import sys
+import timeit
+import argparse
+import tracemalloc
+
+from bot.constants import UserStates
+from bot.errors import MachineError as TableError
+from bot.machine import state_machine
+from bot.utils import User
+
+try:
+    from transitions import Machine, MachineError
+except ImportError:
+    Machine = None
+
+
+INITIAL = UserStates.SELECT_COUNTRY_FROM.value
+
+
+@state_machine(initial=INITIAL)
+class TableModel:
+    states = User.states
+    transitions = User.transitions
+
+    def __init__(self):
+        self.state = self.machine.initial
+
+
+class TransitionsModel:
+    def __init__(self):
+        self.machine = Machine(
+            model=self,
+            states=User.states,
+            initial=INITIAL,
+            transitions=User.transitions,
+        )
+
+
+def conversation(model):
+    model.to_select_place_from()
+    model.to_select_place_to()
+    model.to_select_date_from()
+    model.to_select_date_to()
+    model.to_search_success()
+    model.to_start()
+
+
+def fire(model, trigger: str, errors):
+    """State after ``trigger``, ``None`` when it is not allowed."""
+    try:
+        getattr(model, trigger)()
+    except errors:
+        return None
+    return model.state
+
+
+def check():
+    """Triggers from states where the two machines disagree."""
+    mismatches = []
+    for trigger in sorted(TransitionsModel().machine.events):
+        for state in User.states:
+            table = TableModel()
+            table.machine.set_state(table, state)
+            reference = TransitionsModel()
+            reference.machine.set_state(state)
+            expected = fire(reference, trigger, MachineError)
+            actual = fire(table, trigger, TableError)
+            if actual != expected:
+                mismatches.append((trigger, state, expected, actual))
+    return mismatches
+
+
+def memory_per_instance(factory, count):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    instances = [factory() for _ in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(s.size_diff for s in after.compare_to(before, 'filename'))
+    del instances
+    return size / count
+
+
+def run(name, factory, number):
+    construct = timeit.timeit(factory, number=number) / number
+    model = factory()
+    transition = timeit.timeit(
+        lambda: conversation(model), number=number,
+    ) / number / 6
+    memory = memory_per_instance(factory, min(number, 1000))
+    print('{:<12} construct {:>9.2f} us  transition {:>7.2f} us  '
+          'memory {:>9.0f} B/instance'.format(
+              name, construct * 1e6, transition * 1e6, memory))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--number', type=int, default=10000)
+    parser.add_argument('--check', action='store_true',
+                        help='compare the transitions of both machines')
+    args = parser.parse_args()
+
+    if args.check:
+        if Machine is None:
+            sys.exit('transitions is not installed')
+        mismatches = check()
+        for trigger, state, expected, actual in mismatches:
+            print('{} from {}: expected {}, got {}'.format(
+                trigger, state, expected, actual,
+            ))
+        print('{} mismatches'.format(len(mismatches)))
+        sys.exit(1 if mismatches else 0)
+
+    run('table', TableModel, args.number)
+    if Machine is None:
+        print('transitions is not installed, skipping the comparison')
+    else:
+        run('transitions', TransitionsModel, args.number)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+"""Local stand-ins of Telegram, Skyscanner, redis and Postgres.
+
+Each of them counts the calls made to it, so a benchmark can report the
+round trips an update costs.
+"""
+import os
+import json
+import time
+import zlib
+import random
+import datetime
+import threading
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SYLLABLES = ('ка', 'ро', 'ми', 'на', 'ту', 'ле', 'са', 'во', 'ге', 'ди',
+             'бо', 'ря', 'зе', 'ку', 'по', 'ши')
+
+
+class CallCounter:
+    def __init__(self):
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def inc(self, name: str):
+        with self._lock:
+            self.counts[name] += 1
+
+    def total(self):
+        with self._lock:
+            return sum(self.counts.values())
+
+    def reset(self):
+        with self._lock:
+            self.counts.clear()
+
+
+def make_name(rng: random.Random):
+    return ''.join(
+        rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))
+    ).capitalize()
+
+
+def make_geo(countries: int=30, cities: int=40, seed: int=0):
+    """``geo`` payload with ``countries`` x ``cities`` places."""
+    rng = random.Random(seed)
+    return {'Continents': [{
+        'Id': 'EU',
+        'Name': 'Европа',
+        'Countries': [{
+            'Id': 'C{}'.format(i),
+            'Name': make_name(rng),
+            'Cities': [{
+                'Id': 'C{}-{}'.format(i, j),
+                'Name': make_name(rng),
+            } for j in range(cities)],
+        } for i in range(countries)],
+    }]}
+
+
+def parse_day(value: str, rng: random.Random):
+    """Date of a browsequotes path segment, a random day for a month."""
+    if len(value) == 7:
+        month = datetime.datetime.strptime(value, '%Y-%m').date()
+        return month + datetime.timedelta(days=rng.randrange(28))
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def make_quotes(origin: str,
+                destination: str,
+                outbound: str,
+                inbound: str,
+                count: int=60,
+                seed: int=0):
+    """``browsequotes`` payload for a route, deterministic per ``seed``."""
+    rng = random.Random(seed)
+    if destination == 'anywhere':
+        destinations = ['D{}'.format(i) for i in range(20)]
+    else:
+        destinations = [destination]
+    places = [origin] + destinations
+    carriers = list(range(1, 6))
+
+    def leg(origin_id, destination_id, day):
+        shift = datetime.timedelta(days=rng.randint(-2, 2))
+        return {
+            'OriginId': origin_id,
+            'DestinationId': destination_id,
+            'CarrierIds': [rng.choice(carriers)],
+            'DepartureDate': (day + shift).strftime('%Y-%m-%dT00:00:00'),
+        }
+
+    quotes = []
+    for quote_id in range(count):
+        place = rng.choice(destinations)
+        kind = rng.random()
+        quote = {'QuoteId': quote_id, 'MinPrice': rng.randrange(2000, 40000)}
+        if kind < 0.7:
+            quote['OutboundLeg'] = leg(origin, place,
+                                       parse_day(outbound, rng))
+        if kind > 0.4:
+            quote['InboundLeg'] = leg(place, origin, parse_day(inbound, rng))
+        quotes.append(quote)
+
+    return {
+        'Quotes': quotes,
+        'Places': [{'PlaceId': p, 'Name': p} for p in places],
+        'Carriers': [{'CarrierId': c, 'Name': 'Carrier {}'.format(c)}
+                     for c in carriers],
+        'Currencies': [],
+    }
+
+
+def load_fixtures(path: str):
+    """Recorded ``geo.json`` and ``browsequotes.json`` of a directory."""
+    fixtures = {}
+    for endpoint in ('geo', 'browsequotes'):
+        filename = os.path.join(path, '{}.json'.format(endpoint))
+        if os.path.exists(filename):
+            with open(filename) as f:
+                fixtures[endpoint] = json.load(f)
+    return fixtures
+
+
+class SkyscannerHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        # /apiservices/<endpoint>/v1.0/...
+        parts = self.path.split('?', 1)[0].strip('/').split('/')
+        endpoint = parts[1] if len(parts) > 1 else ''
+        server.counter.inc(endpoint)
+        if server.latency:
+            time.sleep(server.latency * server.rng.uniform(0.5, 1.5))
+
+        if endpoint in server.fixtures:
+            data = server.fixtures[endpoint]
+        elif endpoint == 'geo':
+            data = server.geo
+        elif endpoint == 'browsequotes' and len(parts) == 10:
+            route = parts[6:10]
+            data = make_quotes(*route, count=server.quotes,
+                               seed=zlib.crc32('/'.join(route).encode()))
+        else:
+            return self.reply(404, {'ValidationErrors': []})
+        self.reply(200, data)
+
+    def reply(self, status: int, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockSkyscanner(ThreadingHTTPServer):
+    """Skyscanner API on localhost answering after ``latency`` seconds."""
+
+    daemon_threads = True
+
+    def __init__(self,
+                 latency: float=0.0,
+                 quotes: int=60,
+                 fixtures: dict=None,
+                 geo: dict=None):
+        super().__init__(('127.0.0.1', 0), SkyscannerHandler)
+        self.latency = latency
+        self.quotes = quotes
+        self.fixtures = fixtures or {}
+        self.geo = geo or make_geo()
+        self.rng = random.Random(0)
+        self.counter = CallCounter()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/apiservices'.format(self.server_port)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class FakeTelegram:
+    """Replaces telebot's http requests with canned answers."""
+
+    def __init__(self):
+        self.counter = CallCounter()
+        self._ids = iter(range(1, 1 << 62))
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            return next(self._ids)
+
+    def install(self):
+        from telebot import apihelper
+        apihelper._make_request = self.make_request
+
+    def make_request(self, token, method_name, method='get', params=None,
+                     files=None, **kwargs):
+        self.counter.inc(method_name)
+        params = params or {}
+        if method_name == 'sendMessage':
+            return {
+                'message_id': self.next_id(),
+                'date': int(time.time()),
+                'chat': {'id': params['chat_id'], 'type': 'private'},
+                'text': params.get('text'),
+            }
+        if method_name == 'getChat':
+            return {'id': -self.next_id(), 'type': 'channel',
+                    'title': str(params.get('chat_id'))}
+        return True
+
+
+def count_redis(counter: CallCounter):
+    """Count redis round trips, a pipeline is one of them."""
+    from redis.client import Redis, Pipeline
+
+    execute_command = Redis.execute_command
+    execute = Pipeline.execute
+
+    def counted_command(self, *args, **kwargs):
+        counter.inc(str(args[0]))
+        return execute_command(self, *args, **kwargs)
+
+    def counted_execute(self, *args, **kwargs):
+        counter.inc('PIPELINE')
+        return execute(self, *args, **kwargs)
+
+    Redis.execute_command = counted_command
+    Pipeline.execute = counted_execute
+
+
+def count_queries(database, counter: CallCounter):
+    execute_sql = database.execute_sql
+
+    def counted(sql, *args, **kwargs):
+        counter.inc(sql.split(None, 1)[0].upper())
+        return execute_sql(sql, *args, **kwargs)
+
+    database.execute_sql = counted
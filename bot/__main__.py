@@ -0,0 +1,41 @@
+"""Runs the bot in one of its execution modes.
+
+    python -m bot polling
+    python -m bot async
+    python -m bot webhook
+    python -m bot streams receiver|worker [--index N] [--count N]
+    python -m bot migrate
+    python -m bot check
+"""
+import sys
+import logging
+import argparse
+import importlib
+
+
+MODES = {
+    'polling': ('bot.main', 'run'),
+    'async': ('bot.aio_main', 'main'),
+    'webhook': ('bot.webhook', 'run'),
+    'streams': ('bot.streams', 'main'),
+    'migrate': ('bot.migrations', 'run'),
+    'check': ('bot.app', 'check'),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m bot',
+        description=__doc__.split('\n')[0],
+    )
+    parser.add_argument('mode', choices=sorted(MODES))
+    args, rest = parser.parse_known_args()
+
+    module, function = MODES[args.mode]
+    sys.argv = ['python -m bot {}'.format(args.mode)] + rest
+    getattr(importlib.import_module(module), function)()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,625 @@
+import json
+import time
+import asyncio
+import logging
+import contextlib
+import collections
+import functools
+
+import aiohttp
+from redis import asyncio as aioredis
+from telebot import types, util
+
+from . import metrics
+from .broadcast import BroadcastResult, RateLimiter, should_retry, \
+    transport_error
+from .client import BaseHttpClient, RETRY_STATUSES
+from .constants import REDIS_URL, TELEGRAM_API_URL, \
+    TELEGRAM_LONG_POLLING_TIMEOUT, SESSION_CACHE_SIZE, \
+    SKYSCANNER_POOL_SIZE, SKYSCANNER_RETRY_BACKOFF, \
+    SKYSCANNER_RETRY_BACKOFF_MAX, SKYSCANNER_BREAKER_THRESHOLD, \
+    SKYSCANNER_BREAKER_TIMEOUT, SKYSCANNER_SEARCH_CONCURRENCY, \
+    QUOTES_CACHE_TTL, ANYWHERE_DEADLINE
+from .errors import BaseSkyscannerApiException, TelegramApiError
+from .flexible import stay_months
+from .instrument import observe_handler
+from .anywhere import rank_destinations
+from .quotes import QuoteCache
+from .utils import User, SkyscannerApi
+
+
+logger = logging.getLogger(__name__)
+
+
+async def run_sync(func, *args, **kwargs):
+    """Run blocking code (peewee) in the default executor."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        None, functools.partial(func, *args, **kwargs),
+    )
+
+
+class AsyncHttpClient(BaseHttpClient):
+    """aiohttp counterpart of ``HttpClient`` with the same retry policy."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = None
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+            )
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def get_json(self,
+                       url: str,
+                       endpoint: str,
+                       params: dict=None,
+                       headers: dict=None,
+                       timeout: float=10,
+                       attempts: int=3):
+        breaker = self.get_breaker(endpoint)
+        started = time.monotonic()
+        try:
+            for attempt in range(attempts):
+                self.check_breaker(breaker, endpoint)
+
+                retry_after = None
+                error = None
+                try:
+                    async with self.get_session().get(
+                        url,
+                        headers=headers,
+                        params=params,
+                        timeout=aiohttp.ClientTimeout(total=timeout),
+                    ) as response:
+                        if response.status not in RETRY_STATUSES:
+                            try:
+                                data = await response.json(content_type=None)
+                            except ValueError as e:
+                                raise self.unexpected(
+                                    breaker, endpoint, response.status,
+                                ) from e
+                            self.succeeded(breaker, endpoint)
+                            return data
+
+                        reason = str(response.status)
+                        retry_after = response.headers.get('Retry-After')
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    reason = type(e).__name__
+                    error = e
+
+                last = attempt + 1 == attempts
+                if not self.failed(breaker, endpoint, reason, last):
+                    break
+                await asyncio.sleep(self.delay(attempt, retry_after))
+
+            raise self.give_up(endpoint, attempt + 1, reason) from error
+        finally:
+            elapsed = time.monotonic() - started
+            metrics.skyscanner_request_seconds.inc(elapsed, endpoint=endpoint)
+            metrics.skyscanner_request_duration.observe(
+                elapsed, endpoint=endpoint,
+            )
+
+
+class AsyncSingleflight:
+    """asyncio counterpart of ``Singleflight``."""
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, func):
+        future = self._calls.get(key)
+        if future is not None:
+            return await asyncio.shield(future), True
+
+        future = self._calls[key] = asyncio.ensure_future(func())
+        try:
+            return await asyncio.shield(future), False
+        finally:
+            self._calls.pop(key, None)
+
+
+class AsyncQuoteCache(QuoteCache):
+    def __init__(self, redis, ttl: int=QUOTES_CACHE_TTL):
+        super().__init__(redis, ttl)
+        self.flights = AsyncSingleflight()
+
+    async def get(self, key: str):
+        raw = await self.redis.get(key)
+        if raw is not None:
+            return json.loads(raw.decode())
+
+    async def set(self, key: str, data: dict):
+        await self.redis.set(key, json.dumps(data), ex=self.ttl)
+
+    async def get_or_fetch(self, url: str, fetch):
+        key = self.make_key(url)
+        data = await self.get(key)
+        if data is not None:
+            self.record('hit')
+            return data
+
+        data, shared = await self.flights.do(
+            key, lambda: self._fetch(key, fetch),
+        )
+        self.record('coalesced' if shared else 'miss')
+        return data
+
+    async def _fetch(self, key, fetch):
+        data = await fetch()
+        if self.cacheable(data):
+            await self.set(key, data)
+        return data
+
+
+class AsyncBroadcaster:
+    """asyncio counterpart of ``Broadcaster``."""
+
+    def __init__(self, limiter: RateLimiter=None):
+        self.limiter = limiter or RateLimiter()
+
+    async def acquire(self, chat_id):
+        await asyncio.sleep(self.limiter.chat(chat_id).reserve())
+        await asyncio.sleep(self.limiter.bucket.reserve())
+
+    async def send(self, chat_id, send):
+        attempt = 0
+        while True:
+            await self.acquire(chat_id)
+            try:
+                await send(chat_id)
+            except TelegramApiError as e:
+                attempt += 1
+                if not should_retry(e, attempt):
+                    return BroadcastResult(chat_id, e)
+                await asyncio.sleep(e.retry_after)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # Only this chat fails, the others are still sent to.
+                return BroadcastResult(chat_id, transport_error(e))
+            else:
+                return BroadcastResult(chat_id, None)
+
+    async def broadcast(self, chat_ids, send):
+        return await asyncio.gather(*[
+            self.send(chat_id, send) for chat_id in chat_ids
+        ])
+
+
+class AsyncSkyscannerApi:
+    """Non-blocking Skyscanner calls.
+
+    Urls, parameters and the geo catalog come from the wrapped
+    ``SkyscannerApi``; the catalog is served from memory and refreshed by
+    its own thread, so it never blocks the event loop once warmed up.
+    """
+
+    def __init__(self, api: SkyscannerApi, redis):
+        self.api = api
+        self.quotes = AsyncQuoteCache(redis)
+        self.client = AsyncHttpClient(
+            pool_size=SKYSCANNER_POOL_SIZE,
+            backoff=SKYSCANNER_RETRY_BACKOFF,
+            backoff_max=SKYSCANNER_RETRY_BACKOFF_MAX,
+            breaker_threshold=SKYSCANNER_BREAKER_THRESHOLD,
+            breaker_timeout=SKYSCANNER_BREAKER_TIMEOUT,
+        )
+        self.semaphore = None
+
+    @property
+    def geo(self):
+        return self.api.geo
+
+    async def request(self,
+                      url: str,
+                      params: dict=None,
+                      timeout: int=10,
+                      attempts: int=3):
+        endpoint, params, headers = self.api.prepare_request(url, params)
+        return await self.client.get_json(
+            url,
+            endpoint,
+            params=params,
+            headers=headers,
+            timeout=timeout,
+            attempts=attempts,
+        )
+
+    async def get_quotes(self, u: User, date_from, date_to):
+        url = self.api.make_search_url(u, date_from, date_to)
+        async with self.semaphore:
+            return await self.quotes.get_or_fetch(
+                url, lambda: self.request(url),
+            )
+
+    async def search_window(self, u: User, date_from, date_to):
+        data = await self.get_quotes(u, date_from, date_to)
+        return self.api.make_ticket(u, data, date_from, date_to)
+
+    async def search_anywhere(self,
+                              u: User,
+                              attempts: int=3,
+                              deadline: float=ANYWHERE_DEADLINE):
+        self.ensure_semaphore()
+        tasks = [
+            asyncio.ensure_future(self.get_quotes(u, date_from, date_to))
+            for date_from, date_to in self.api.search_windows(u, attempts)
+        ]
+        await asyncio.wait(tasks, timeout=deadline)
+        await asyncio.wait(tasks[:1])
+
+        results = []
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+                continue
+            error = task.exception()
+            if error is None:
+                results.append(task.result())
+            elif isinstance(error, BaseSkyscannerApiException):
+                results.append(error)
+            else:
+                raise error
+        return rank_destinations(self.api.pick_payloads(results))
+
+    async def search_month(self, u: User, inbound_month):
+        url = self.api.make_month_search_url(u, u.date_from, inbound_month)
+        async with self.semaphore:
+            return await self.quotes.get_or_fetch(
+                url, lambda: self.request(url),
+            )
+
+    async def search_flexible(self, u: User, stay: int):
+        self.ensure_semaphore()
+        payloads = await asyncio.gather(*[
+            self.search_month(u, inbound_month)
+            for inbound_month in stay_months(u.date_from, stay)
+        ])
+        return self.api.make_flexible_ticket(u, payloads, stay)
+
+    def ensure_semaphore(self):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(SKYSCANNER_SEARCH_CONCURRENCY)
+
+    async def search(self, u: User, attempts: int=3):
+        self.ensure_semaphore()
+
+        results = await asyncio.gather(*[
+            self.search_window(u, date_from, date_to)
+            for date_from, date_to in self.api.search_windows(u, attempts)
+        ], return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, Exception) and \
+                    not isinstance(result, BaseSkyscannerApiException):
+                raise result
+        return self.api.pick_cheapest(results)
+
+
+class AsyncSessionManager:
+    """asyncio counterpart of ``SessionManager`` on top of redis.asyncio."""
+
+    def __init__(self, redis, size: int=SESSION_CACHE_SIZE):
+        self.redis = redis
+        self.size = size
+        self._sessions = collections.OrderedDict()
+        self._loading = {}
+
+    def __len__(self):
+        return len(self._sessions)
+
+    async def get(self, user_id):
+        session = self._sessions.get(user_id)
+        if session is not None:
+            self._sessions.move_to_end(user_id)
+            metrics.session_cache_requests.inc(result='hit')
+            return session
+
+        metrics.session_cache_requests.inc(result='miss')
+        loading = self._loading.get(user_id)
+        if loading is None:
+            loading = asyncio.ensure_future(self._load(user_id))
+            self._loading[user_id] = loading
+        return await asyncio.shield(loading)
+
+    async def _load(self, user_id):
+        try:
+            session = User(user_id, load=False)
+            pipe = self.redis.pipeline(transaction=False)
+            session.queue_load(pipe)
+            with metrics.redis_session_seconds.time(operation='load'):
+                data, _ = await pipe.execute()
+            session.load_fields(data)
+            self.put(session)
+            return session
+        finally:
+            self._loading.pop(user_id, None)
+
+    def put(self, session):
+        self._sessions[session.user_id] = session
+        self._sessions.move_to_end(session.user_id)
+        while len(self._sessions) > self.size:
+            _, evicted = self._sessions.popitem(last=False)
+            asyncio.ensure_future(self.flush(evicted))
+
+    async def flush(self, session):
+        if not session.dirty:
+            return
+
+        pipe = self.redis.pipeline(transaction=False)
+        session.queue_flush(pipe)
+        with metrics.redis_session_seconds.time(operation='flush'):
+            await pipe.execute()
+        session.dirty.clear()
+
+    async def clear(self, session):
+        await self.redis.delete(session.key)
+        session.reset()
+        session.dirty.clear()
+
+
+class AsyncServices:
+    """Services of ``bot.conversation`` for the asyncio mode."""
+
+    def __init__(self,
+                 bot,
+                 sessions: AsyncSessionManager,
+                 api: AsyncSkyscannerApi,
+                 broadcaster: AsyncBroadcaster):
+        self.bot = bot
+        self.sessions = sessions
+        self.api = api
+        self.broadcaster = broadcaster
+
+    @property
+    def geo(self):
+        return self.api.geo
+
+    async def send_message(self,
+                           chat_id,
+                           text: str,
+                           reply_markup=None,
+                           disable_notification: bool=None):
+        return await self.bot.send_message(
+            chat_id,
+            text,
+            reply_markup=reply_markup,
+            disable_notification=disable_notification,
+        )
+
+    async def get_chat(self, chat_id):
+        return await self.bot.get_chat(chat_id)
+
+    async def answer_inline_query(self,
+                                  inline_query_id,
+                                  results,
+                                  cache_time: int=None,
+                                  next_offset: str=None):
+        return await self.bot.answer_inline_query(
+            inline_query_id,
+            results,
+            cache_time=cache_time,
+            next_offset=next_offset,
+        )
+
+    async def broadcast(self, chat_ids, text: str, reply_markup=None):
+        return await self.broadcaster.broadcast(
+            chat_ids,
+            lambda chat_id: self.bot.send_message(
+                chat_id, text, reply_markup=reply_markup,
+            ),
+        )
+
+    async def run_blocking(self, func, *args):
+        return await run_sync(func, *args)
+
+    async def get_session(self, user_id):
+        return await self.sessions.get(user_id)
+
+    def lock(self, u):
+        # AsyncRunner already handles the updates of a user one at a time.
+        return contextlib.nullcontext()
+
+    async def flush(self, u):
+        await self.sessions.flush(u)
+
+    async def clear(self, u):
+        await self.sessions.clear(u)
+
+    async def search(self, u):
+        return await self.api.search(u)
+
+    async def search_flexible(self, u, stay: int):
+        return await self.api.search_flexible(u, stay)
+
+    async def search_anywhere(self, u):
+        return await self.api.search_anywhere(u)
+
+
+class AsyncBot:
+    """Minimal Telegram Bot API client on aiohttp.
+
+    Handlers are coroutines registered per command, text messages without
+    a registered command go to the ``default`` handler and inline queries
+    to the ``inline`` one.
+    """
+
+    def __init__(self, token: str):
+        self.token = token
+        self.commands = {}
+        self.default = None
+        self.inline = None
+        self.session = None
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession()
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    def command(self, *commands):
+        def decorator(func):
+            for command in commands:
+                self.commands[command] = func
+            return func
+        return decorator
+
+    def message(self, func):
+        self.default = func
+        return func
+
+    def inline_query(self, func):
+        self.inline = func
+        return func
+
+    async def call(self, method: str, timeout: float=None, **params):
+        payload = {k: v for k, v in params.items() if v is not None}
+        if timeout is None:
+            timeout = TELEGRAM_LONG_POLLING_TIMEOUT
+        async with self.get_session().post(
+            TELEGRAM_API_URL.format(self.token, method),
+            json=payload,
+            timeout=aiohttp.ClientTimeout(total=timeout + 10),
+        ) as response:
+            try:
+                result = await response.json(content_type=None)
+            except ValueError:
+                result = None
+
+        # HTML error pages of a proxy and empty bodies fail like API errors.
+        if not isinstance(result, dict):
+            raise TelegramApiError(
+                'Unexpected response {}'.format(response.status),
+                response.status,
+            )
+        if not result.get('ok'):
+            parameters = result.get('parameters') or {}
+            raise TelegramApiError(
+                result.get('description'),
+                result.get('error_code'),
+                parameters.get('retry_after'),
+            )
+        return result['result']
+
+    async def get_updates(self, offset: int=None, timeout: int=None):
+        if timeout is None:
+            timeout = TELEGRAM_LONG_POLLING_TIMEOUT
+        result = await self.call(
+            'getUpdates', offset=offset, timeout=timeout,
+        )
+        return [types.Update.de_json(update) for update in result]
+
+    async def send_message(self,
+                           chat_id,
+                           text: str,
+                           reply_markup=None,
+                           disable_notification: bool=None):
+        if reply_markup is not None:
+            reply_markup = json.loads(reply_markup.to_json())
+        result = await self.call(
+            'sendMessage',
+            chat_id=chat_id,
+            text=text,
+            reply_markup=reply_markup,
+            disable_notification=disable_notification,
+        )
+        return types.Message.de_json(result)
+
+    async def get_chat(self, chat_id):
+        return types.Chat.de_json(await self.call('getChat', chat_id=chat_id))
+
+    async def answer_inline_query(self,
+                                  inline_query_id,
+                                  results,
+                                  cache_time: int=None,
+                                  next_offset: str=None):
+        return await self.call(
+            'answerInlineQuery',
+            inline_query_id=inline_query_id,
+            results=[json.loads(result.to_json()) for result in results],
+            cache_time=cache_time,
+            next_offset=next_offset,
+        )
+
+    async def process_update(self, update):
+        if update.inline_query is not None and self.inline is not None:
+            with observe_handler(self.inline.__name__):
+                await self.inline(update.inline_query)
+            return
+
+        message = update.message
+        if message is None or message.content_type != 'text':
+            return
+
+        handler = self.commands.get(util.extract_command(message.text))
+        if handler is None:
+            handler = self.default
+        if handler is not None:
+            with observe_handler(handler.__name__):
+                await handler(message)
+
+
+class AsyncRunner:
+    """Long polling loop handling updates concurrently.
+
+    At most ``concurrency`` updates are processed at once, updates of the
+    same user are processed one at a time and in order.
+    """
+
+    def __init__(self, bot: AsyncBot, concurrency: int):
+        self.bot = bot
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.user_locks = {}
+
+    @staticmethod
+    def get_user_id(update):
+        if update.inline_query is not None:
+            return update.inline_query.from_user.id
+        message = update.message
+        if message is not None and message.from_user is not None:
+            return message.from_user.id
+
+    async def poll(self):
+        offset = None
+        while True:
+            try:
+                updates = await self.bot.get_updates(offset)
+            except (aiohttp.ClientError, asyncio.TimeoutError,
+                    TelegramApiError):
+                logger.exception('Failed to get updates')
+                await asyncio.sleep(1)
+                continue
+
+            for update in updates:
+                offset = update.update_id + 1
+                await self.semaphore.acquire()
+                asyncio.ensure_future(self.handle(update))
+
+    async def handle(self, update):
+        user_id = self.get_user_id(update)
+        entry = self.user_locks.setdefault(user_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self.bot.process_update(update)
+        except Exception:
+            logger.exception('Failed to process update %s', update.update_id)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.user_locks[user_id]
+            self.semaphore.release()
+
+
+def create_redis():
+    return aioredis.from_url(REDIS_URL)
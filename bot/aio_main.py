@@ -0,0 +1,65 @@
+"""asyncio execution mode of the bot.
+
+Runs ``bot.conversation`` with Telegram, Skyscanner and redis calls made
+without blocking the event loop and peewee queries moved to the default
+executor.
+
+    python -m bot.aio_main
+"""
+import asyncio
+import logging
+
+from bot.aio import AsyncBot, AsyncBroadcaster, AsyncRunner, \
+    AsyncServices, AsyncSessionManager, AsyncSkyscannerApi, create_redis, \
+    run_sync
+from bot.app import create_app
+from bot.constants import TOKEN, ASYNC_CONCURRENCY
+from bot.conversation import Conversation, commands
+from bot.utils import api as sync_api, redis as sync_redis, Lazy
+from bot.writes import writes
+from bot.watch import PriceWatcher
+
+
+bot = AsyncBot(TOKEN)
+redis = Lazy(create_redis)
+api = AsyncSkyscannerApi(sync_api, redis)
+loop = asyncio.get_event_loop()
+
+
+def notify_from_thread(chat_id, ticket):
+    # The watcher runs in threads, notifications are sent on the loop.
+    asyncio.run_coroutine_threadsafe(
+        conversation.notify_price_drop(chat_id, ticket), loop,
+    ).result()
+
+
+watcher = PriceWatcher(sync_api, sync_redis, notify_from_thread)
+conversation = Conversation(
+    AsyncServices(bot, AsyncSessionManager(redis), api, AsyncBroadcaster()),
+    watcher,
+)
+
+for command, handler in commands.items():
+    bot.command(command)(getattr(conversation, handler.__name__))
+bot.inline_query(conversation.suggest_places)
+bot.message(conversation.route)
+
+
+async def run():
+    # Started in a thread, the checks warm the geo catalog the handlers
+    # then read from memory.
+    await run_sync(create_app(services=[writes, watcher]).start)
+    try:
+        await AsyncRunner(bot, ASYNC_CONCURRENCY).poll()
+    finally:
+        await bot.close()
+        await api.client.close()
+
+
+def main():
+    loop.run_until_complete(run())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,71 @@
+import heapq
+import operator
+
+from .constants import Option, Ticket, ANYWHERE_RESULTS
+
+
+def rank_destinations(payloads, limit: int=ANYWHERE_RESULTS):
+    """Cheapest trip to each destination of ``anywhere`` browse quotes."""
+    best = {}
+    for data in payloads:
+        # Error bodies such as ValidationErrors of past dates.
+        if not data.get('Quotes'):
+            continue
+
+        ticket = Ticket()
+        ticket.fill_from_data(data)
+
+        # One way quotes are paired with the cheapest way back from the
+        # same place.
+        inbounds = {}
+        for quote in ticket.inbounds:
+            origin = quote.inbound.origin
+            if origin not in inbounds or \
+                    quote.price < inbounds[origin].price:
+                inbounds[origin] = quote
+
+        trips = [
+            (q.outbound.destination, q.price, q.outbound, q.inbound,
+             q.price, q.price)
+            for q in ticket.round_trips
+        ]
+        for quote in ticket.outbounds:
+            inbound = inbounds.get(quote.outbound.destination)
+            if inbound is None or \
+                    inbound.inbound.departure < quote.outbound.departure:
+                continue
+            trips.append((
+                quote.outbound.destination,
+                quote.price + inbound.price,
+                quote.outbound,
+                inbound.inbound,
+                quote.price,
+                inbound.price,
+            ))
+
+        for trip in trips:
+            destination, price, outbound, inbound, out_price, in_price = trip
+            if destination in best and best[destination].price <= price:
+                continue
+            best[destination] = Option(
+                price,
+                ticket.make_flight(outbound, out_price),
+                ticket.make_flight(inbound, in_price),
+            )
+
+    return heapq.nsmallest(limit, best.values(),
+                           key=operator.attrgetter('price'))
+
+
+def destinations_message(destinations):
+    message = 'Самые дешевые направления:\n'
+    for number, option in enumerate(destinations, 1):
+        message += '{}. {}: от {} руб. ({} - {}, {})\n'.format(
+            number,
+            option.outbound.place_to,
+            option.price,
+            option.outbound.date,
+            option.inbound.date,
+            option.outbound.carrier or option.inbound.carrier,
+        )
+    return message
@@ -0,0 +1,105 @@
+"""Application factory of the bot processes.
+
+Importing the bot opens no connections and needs no configuration: the
+database is bound and the redis and Skyscanner clients are made when a
+process starts. ``App.start`` runs the start up checks concurrently, they
+warm what the first replies need (geo catalog, connections), and then
+starts the background services.
+"""
+import sys
+import time
+import logging
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from . import metrics
+from .constants import METRICS_PORT, READY_TIMEOUT
+from .utils import redis, db, api, init_db
+
+
+logger = logging.getLogger(__name__)
+
+
+def check_database():
+    with db.connection_context():
+        db.execute_sql('SELECT 1')
+
+
+class App:
+    retry_interval = 5
+
+    def __init__(self, checks: dict=None, services=()):
+        self.checks = collections.OrderedDict(checks or {})
+        self.services = list(services)
+        self.ready = threading.Event()
+
+    def warm_up(self, timeout: float=READY_TIMEOUT):
+        """Run the checks concurrently, return the names of failed ones."""
+        started = time.monotonic()
+        executor = ThreadPoolExecutor(max(len(self.checks), 1))
+        futures = collections.OrderedDict(
+            (name, executor.submit(check))
+            for name, check in self.checks.items()
+        )
+        done, _ = wait(futures.values(), timeout=timeout)
+        executor.shutdown(wait=False)
+
+        failed = []
+        for name, future in futures.items():
+            if future not in done:
+                logger.error('Start up check %s timed out', name)
+                failed.append(name)
+            elif future.exception() is not None:
+                logger.error('Start up check %s failed: %s',
+                             name, future.exception())
+                failed.append(name)
+
+        if not failed:
+            self.ready.set()
+            logger.info('Ready in %.2fs', time.monotonic() - started)
+        return failed
+
+    def keep_warming(self):
+        while self.warm_up():
+            time.sleep(self.retry_interval)
+
+    def start(self):
+        """Serve metrics, warm up and start the background services.
+
+        The services are started even when a check failed, the checks are
+        then retried in the background until the process is ready.
+        """
+        metrics.start_server(METRICS_PORT)
+        if self.warm_up():
+            thread = threading.Thread(target=self.keep_warming)
+            thread.daemon = True
+            thread.start()
+        for service in self.services:
+            service.start()
+        return self
+
+
+def create_app(database=None, bot=None, services=()):
+    """App of a process handling updates.
+
+    Checking ``bot``, a ``TeleBot``, opens the connection to Telegram
+    before the first reply needs it. The geo catalog refresh is started
+    along with ``services``.
+    """
+    init_db(database)
+    checks = {
+        'redis': redis.ping,
+        'database': check_database,
+        'geo': api.geo.ensure_loaded,
+    }
+    if bot is not None:
+        checks['telegram'] = bot.get_me
+    return App(checks, [api.geo] + list(services))
+
+
+def check():
+    """Exit with 1 unless all the start up checks pass."""
+    from bot.main import bot
+
+    sys.exit(1 if create_app(bot=bot).warm_up() else 0)
@@ -0,0 +1,154 @@
+import time
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from telebot import apihelper
+
+from .constants import BROADCAST_GLOBAL_RATE, BROADCAST_CHAT_RATE, \
+    BROADCAST_WORKERS, BROADCAST_MAX_RETRIES
+from .errors import TelegramApiError
+
+
+# Idle buckets are dropped once there are more chats than this.
+CHAT_BUCKETS_LIMIT = 1000
+
+BroadcastResult = collections.namedtuple('BroadcastResult', 'chat_id error')
+
+
+class TokenBucket:
+    """Allows ``rate`` calls a second with bursts up to ``capacity``."""
+
+    def __init__(self, rate: float, capacity: float=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated) * self.rate,
+        )
+        self.updated = now
+
+    def reserve(self):
+        """Take a token, return seconds to wait before it may be used."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def idle(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return self.tokens >= self.capacity
+
+
+class RateLimiter:
+    """Telegram's global limit of the bot and the limit of every chat."""
+
+    def __init__(self,
+                 global_rate: float=BROADCAST_GLOBAL_RATE,
+                 chat_rate: float=BROADCAST_CHAT_RATE):
+        self.bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chats = {}
+        self._lock = threading.Lock()
+
+    def chat(self, chat_id):
+        with self._lock:
+            bucket = self.chats.get(chat_id)
+            if bucket is None:
+                if len(self.chats) >= CHAT_BUCKETS_LIMIT:
+                    self.prune()
+                bucket = self.chats[chat_id] = TokenBucket(self.chat_rate)
+            return bucket
+
+    def prune(self):
+        for chat_id, bucket in list(self.chats.items()):
+            if bucket.idle():
+                del self.chats[chat_id]
+
+    def acquire(self, chat_id):
+        # The chat slot goes first, a global token taken while waiting
+        # for it would be wasted.
+        time.sleep(self.chat(chat_id).reserve())
+        time.sleep(self.bucket.reserve())
+
+
+def to_telegram_error(e: apihelper.ApiException):
+    """TelegramApiError with the code and retry_after of a telebot error."""
+    try:
+        result = e.result.json()
+    except (AttributeError, ValueError):
+        return TelegramApiError(str(e))
+    parameters = result.get('parameters') or {}
+    return TelegramApiError(
+        result.get('description'),
+        result.get('error_code'),
+        parameters.get('retry_after'),
+    )
+
+
+def transport_error(e: Exception):
+    """TelegramApiError of a network error, the chat is tried later."""
+    return TelegramApiError(str(e) or type(e).__name__)
+
+
+def should_retry(error: TelegramApiError, attempt: int):
+    return error.retry_after is not None and attempt < BROADCAST_MAX_RETRIES
+
+
+def summarize(results):
+    """One message about the whole broadcast."""
+    sent = [r.chat_id for r in results if r.error is None]
+    lines = ['Сообщение отправлено в {} из {} каналов'.format(
+        len(sent), len(results),
+    )]
+    for result in results:
+        if result.error is None:
+            continue
+        if result.error.error_code in (400, 403):
+            lines.append('Нужно предоставить боту админ права в '
+                         'канале {}'.format(result.chat_id))
+        else:
+            lines.append('Не удалось отправить сообщение в канал {}, '
+                         'попробуйте позже'.format(result.chat_id))
+    return '\n'.join(lines)
+
+
+class Broadcaster:
+    """Sends to many chats concurrently under a RateLimiter."""
+
+    def __init__(self,
+                 limiter: RateLimiter=None,
+                 workers: int=BROADCAST_WORKERS):
+        self.limiter = limiter or RateLimiter()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def send(self, chat_id, send):
+        attempt = 0
+        while True:
+            self.limiter.acquire(chat_id)
+            try:
+                send(chat_id)
+            except apihelper.ApiException as e:
+                error = to_telegram_error(e)
+                attempt += 1
+                if not should_retry(error, attempt):
+                    return BroadcastResult(chat_id, error)
+                time.sleep(error.retry_after)
+            except requests.RequestException as e:
+                # Only this chat fails, the others are still sent to.
+                return BroadcastResult(chat_id, transport_error(e))
+            else:
+                return BroadcastResult(chat_id, None)
+
+    def broadcast(self, chat_ids, send):
+        """Call ``send(chat_id)`` for every chat, results in the same order."""
+        return list(self.executor.map(
+            lambda chat_id: self.send(chat_id, send), chat_ids,
+        ))
@@ -0,0 +1,60 @@
+import json
+
+from .constants import CHANNELS_CACHE_TTL
+from .utils import redis, db_connection, BotUser, Channel
+from .writes import writes
+
+
+class ChannelStore:
+    """Channels of the users, read through a redis cache.
+
+    Changes are written to the cache at once and to the database by the
+    write-behind queue, so the handlers only query the database when a
+    cached list expires.
+    """
+
+    def __init__(self, redis, writes, ttl: int=CHANNELS_CACHE_TTL):
+        self.redis = redis
+        self.writes = writes
+        self.ttl = ttl
+
+    @staticmethod
+    def make_key(uid):
+        return 'channels_{}'.format(uid)
+
+    def get(self, uid):
+        """Channel names of the user in the order they were added."""
+        key = self.make_key(uid)
+        raw = self.redis.get(key)
+        if raw is not None:
+            return json.loads(raw.decode())
+
+        with db_connection():
+            names = [
+                c.uid for c in Channel.select(Channel.uid)
+                .join(BotUser)
+                .where(BotUser.uid == str(uid))
+                .order_by(Channel.id)
+            ]
+        # Empty lists are cached as well, most users have no channels.
+        self.cache(uid, names)
+        return names
+
+    def cache(self, uid, names):
+        self.redis.set(self.make_key(uid), json.dumps(names), ex=self.ttl)
+
+    def add(self, uid, name: str):
+        names = self.get(uid)
+        if name not in names:
+            self.cache(uid, names + [name])
+        self.writes.add_channel(uid, name)
+
+    def delete(self, uid, name: str):
+        names = self.get(uid)
+        if name not in names:
+            raise Channel.DoesNotExist(name)
+        self.cache(uid, [n for n in names if n != name])
+        self.writes.delete_channel(uid, name)
+
+
+channel_store = ChannelStore(redis, writes)
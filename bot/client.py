@@ -0,0 +1,206 @@
+import time
+import random
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+from .errors import SkyscannerApiUnavailable
+
+
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+class CircuitBreaker:
+    """Stops calling an endpoint after ``threshold`` failures in a row.
+
+    After ``reset_timeout`` seconds a single trial request is let through,
+    its result closes the breaker again or keeps it open.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and \
+                    time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        """Register a failure, return True when it opened the breaker."""
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (
+                    self.state == self.CLOSED and
+                    self.failures >= self.threshold):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+
+class BaseHttpClient:
+    """Retry and circuit breaker policy shared by the http clients.
+
+    Request errors (timeouts, refused connections), 5xx and 429 responses
+    are retried with exponential backoff and full jitter. Once an
+    endpoint's breaker is open, calls fail fast with
+    ``SkyscannerApiUnavailable``. Bodies that are not JSON, error pages of
+    proxies for instance, fail with it too and are not retried.
+    """
+
+    def __init__(self,
+                 pool_size: int,
+                 backoff: float,
+                 backoff_max: float,
+                 breaker_threshold: int,
+                 breaker_timeout: float):
+        self.pool_size = pool_size
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_timeout = breaker_timeout
+        self.breakers = {}
+        self._lock = threading.Lock()
+
+    def get_breaker(self, endpoint: str):
+        with self._lock:
+            if endpoint not in self.breakers:
+                self.breakers[endpoint] = CircuitBreaker(
+                    self.breaker_threshold,
+                    self.breaker_timeout,
+                )
+            return self.breakers[endpoint]
+
+    def delay(self, attempt: int, retry_after: str=None):
+        delay = random.uniform(
+            0, min(self.backoff_max, self.backoff * 2 ** attempt),
+        )
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(float(retry_after), self.backoff_max))
+        return delay
+
+    def check_breaker(self, breaker, endpoint: str):
+        if not breaker.allow():
+            metrics.skyscanner_requests.inc(
+                endpoint=endpoint, outcome='rejected',
+            )
+            raise SkyscannerApiUnavailable(
+                'Circuit breaker for {} is open'.format(endpoint)
+            )
+
+    def succeeded(self, breaker, endpoint: str):
+        breaker.record_success()
+        metrics.skyscanner_requests.inc(endpoint=endpoint, outcome='ok')
+
+    def failed(self, breaker, endpoint: str, reason: str, last: bool):
+        """Register a failed attempt, return True when it can be retried."""
+        if breaker.record_failure():
+            metrics.skyscanner_breaker_trips.inc(endpoint=endpoint)
+            return False
+        if last:
+            return False
+
+        metrics.skyscanner_retries.inc(endpoint=endpoint, reason=reason)
+        return True
+
+    def unexpected(self, breaker, endpoint: str, status: int):
+        """Register a response that is not JSON, such as a proxy page."""
+        if breaker.record_failure():
+            metrics.skyscanner_breaker_trips.inc(endpoint=endpoint)
+        metrics.skyscanner_requests.inc(endpoint=endpoint, outcome='failed')
+        return SkyscannerApiUnavailable(
+            '{} returned a non-JSON {} response'.format(endpoint, status)
+        )
+
+    def give_up(self, endpoint: str, attempts: int, reason: str):
+        metrics.skyscanner_requests.inc(endpoint=endpoint, outcome='failed')
+        return SkyscannerApiUnavailable(
+            '{} failed after {} attempts: {}'.format(
+                endpoint, attempts, reason,
+            )
+        )
+
+
+class HttpClient(BaseHttpClient):
+    """Keep-alive JSON client on top of a pooled ``requests.Session``."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size,
+                              pool_maxsize=self.pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get_json(self,
+                 url: str,
+                 endpoint: str,
+                 params: dict=None,
+                 headers: dict=None,
+                 timeout: float=10,
+                 attempts: int=3):
+        breaker = self.get_breaker(endpoint)
+        started = time.monotonic()
+        try:
+            for attempt in range(attempts):
+                self.check_breaker(breaker, endpoint)
+
+                retry_after = None
+                error = None
+                try:
+                    response = self.session.get(
+                        url,
+                        headers=headers,
+                        params=params,
+                        timeout=timeout,
+                    )
+                except requests.RequestException as e:
+                    reason = type(e).__name__
+                    error = e
+                else:
+                    if response.status_code not in RETRY_STATUSES:
+                        try:
+                            data = response.json()
+                        except ValueError as e:
+                            raise self.unexpected(
+                                breaker, endpoint, response.status_code,
+                            ) from e
+                        self.succeeded(breaker, endpoint)
+                        return data
+
+                    reason = str(response.status_code)
+                    retry_after = response.headers.get('Retry-After')
+
+                last = attempt + 1 == attempts
+                if not self.failed(breaker, endpoint, reason, last):
+                    break
+                time.sleep(self.delay(attempt, retry_after))
+
+            raise self.give_up(endpoint, attempt + 1, reason) from error
+        finally:
+            elapsed = time.monotonic() - started
+            metrics.skyscanner_request_seconds.inc(elapsed, endpoint=endpoint)
+            metrics.skyscanner_request_duration.observe(
+                elapsed, endpoint=endpoint,
+            )
@@ -1,32 +1,132 @@
 import os
+import json
 import enum
+import heapq
 import datetime
+import operator
 import collections
 
-from urllib import parse
-
 
 USER_DATE_FORMAT = '%d.%m.%Y'
+USER_MONTH_FORMAT = '%m.%Y'
 TOKEN = os.environ.get('TOKEN')
 POOLING_TIMEOUT = 10000000000000
+TELEGRAM_API_URL = 'https://api.telegram.org/bot{}/{}'
+TELEGRAM_LONG_POLLING_TIMEOUT = 30
+ASYNC_CONCURRENCY = int(os.environ.get('ASYNC_CONCURRENCY', 1000))
+
+# Telegram allows about 30 messages a second overall and 20 a minute
+# to the same group or channel.
+BROADCAST_GLOBAL_RATE = float(os.environ.get('BROADCAST_GLOBAL_RATE', 30))
+BROADCAST_CHAT_RATE = float(os.environ.get('BROADCAST_CHAT_RATE', 20 / 60))
+BROADCAST_WORKERS = int(os.environ.get('BROADCAST_WORKERS', 8))
+BROADCAST_MAX_RETRIES = 3
+
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_PORT = int(os.environ.get('PORT', 8443))
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS',
+                                     (os.cpu_count() or 1) * 4))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 100))
+# Seconds the start up checks may take before the process starts anyway.
+READY_TIMEOUT = float(os.environ.get('READY_TIMEOUT', 30))
+
+# Port of the standalone /metrics server, the webhook serves it on PORT.
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+# Stacks of updates slower than this many seconds are logged, 0 is off.
+PROFILE_SLOW_UPDATES = float(os.environ.get('PROFILE_SLOW_UPDATES', 0))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.01))
+
+STREAM_KEY = 'updates'
+STREAM_GROUP = 'workers'
+STREAM_SHARDS = int(os.environ.get('STREAM_SHARDS', 16))
+STREAM_MAXLEN = int(os.environ.get('STREAM_MAXLEN', 100000))
+STREAM_BLOCK = 5000
+STREAM_BATCH = 100
+# Entries another consumer left pending this long, ms, are taken over.
+STREAM_RETRY_IDLE = int(os.environ.get('STREAM_RETRY_IDLE', 30000))
+STREAM_MAX_DELIVERIES = int(os.environ.get('STREAM_MAX_DELIVERIES', 5))
+# Seconds before retrying a failed entry or read, doubled up to the max.
+STREAM_RETRY_BACKOFF = float(os.environ.get('STREAM_RETRY_BACKOFF', 0.5))
+STREAM_RETRY_BACKOFF_MAX = 30
 
 SKYSCANNER_TOKEN = os.environ.get('SKYSCANNER_TOKEN')
 SKYSCANNER_LOCALE = 'ru-RU'
 SKYSCANNER_CURRENCY = 'RUB'
-SKYSCANNER_API_URL = 'http://partners.api.skyscanner.net/apiservices'
+SKYSCANNER_API_URL = os.environ.get(
+    'SKYSCANNER_API_URL',
+    'http://partners.api.skyscanner.net/apiservices',
+)
 SKYSCANNER_API_VERSION = 'v1.0'
 SKYSCANNER_DATE_FORMAT = '%Y-%m-%d'
 SKYSCANNER_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+SKYSCANNER_MONTH_FORMAT = '%Y-%m'
+FLEXIBLE_MAX_STAY = 30
+ANYWHERE = 'anywhere'
+ANYWHERE_NAMES = ('везде', 'anywhere')
+ANYWHERE_RESULTS = 10
+ANYWHERE_DEADLINE = float(os.environ.get('ANYWHERE_DEADLINE', 5))
+TICKET_OPTIONS = 3
+SKYSCANNER_POOL_SIZE = int(os.environ.get('SKYSCANNER_POOL_SIZE', 20))
+SKYSCANNER_RETRY_BACKOFF = float(os.environ.get('SKYSCANNER_RETRY_BACKOFF',
+                                                0.5))
+SKYSCANNER_RETRY_BACKOFF_MAX = float(
+    os.environ.get('SKYSCANNER_RETRY_BACKOFF_MAX', 8)
+)
+SKYSCANNER_BREAKER_THRESHOLD = int(
+    os.environ.get('SKYSCANNER_BREAKER_THRESHOLD', 5)
+)
+SKYSCANNER_BREAKER_TIMEOUT = float(
+    os.environ.get('SKYSCANNER_BREAKER_TIMEOUT', 30)
+)
+SKYSCANNER_SEARCH_CONCURRENCY = int(
+    os.environ.get('SKYSCANNER_SEARCH_CONCURRENCY', 8)
+)
+QUOTES_CACHE_TTL = int(os.environ.get('QUOTES_CACHE_TTL', 10 * 60))
+
+WATCH_INTERVAL = int(os.environ.get('WATCH_INTERVAL', 3 * 60 * 60))
+WATCH_CONCURRENCY = int(os.environ.get('WATCH_CONCURRENCY', 4))
 
 REDIS_URL = os.environ.get('REDIS_URL')
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 30 * 24 * 60 * 60))
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', 10000))
+
+GEO_CACHE_KEY = 'geo_catalog'
+GEO_CACHE_TTL = int(os.environ.get('GEO_CACHE_TTL', 24 * 60 * 60))
+GEO_CACHE_STALE_TTL = int(os.environ.get('GEO_CACHE_STALE_TTL',
+                                         7 * 24 * 60 * 60))
+GEO_CACHE_LOCK_TIMEOUT = 60
+# Failed refreshes of a stale catalog are retried after this many seconds,
+# doubled on each failure up to the max.
+GEO_REFRESH_BACKOFF = 30
+GEO_REFRESH_MAX_BACKOFF = 30 * 60
+# Geo catalog file built by ``python -m bot.snapshot build``.
+GEO_SNAPSHOT_PATH = os.environ.get('GEO_SNAPSHOT_PATH')
+
+SEARCH_RESULTS_LIMIT = 5
+SEARCH_SCAN_LIMIT = 200
+SEARCH_FUZZY_THRESHOLD = 0.3
+
+# Telegram shows at most 50 inline results an answer.
+INLINE_PAGE_SIZE = 20
+INLINE_RESULTS_LIMIT = 100
+INLINE_COUNTRIES_LIMIT = 3
+INLINE_CACHE_SIZE = int(os.environ.get('INLINE_CACHE_SIZE', 10000))
+# Seconds Telegram may serve an answer to everyone typing the same query.
+INLINE_CACHE_TIME = int(os.environ.get('INLINE_CACHE_TIME', 300))
 
-DB_URL = parse.urlparse(os.environ["DATABASE_URL"])
+# Parsed when the database is created, importing the bot needs no config.
+DATABASE_URL = os.environ.get('DATABASE_URL')
+# 0 keeps a connection open per thread, otherwise connections are pooled.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 0))
+DB_POOL_STALE_TIMEOUT = int(os.environ.get('DB_POOL_STALE_TIMEOUT', 300))
 
-DB_NAME = DB_URL.path[1:]
-DB_USERNAME = DB_URL.username
-DB_PASSWORD = DB_URL.password
-DB_HOST = DB_URL.hostname
-DB_PORT = DB_URL.port
+BOT_USERS_KEY = 'bot_users'
+WRITE_QUEUE_KEY = 'db_writes'
+WRITE_BATCH_SIZE = int(os.environ.get('WRITE_BATCH_SIZE', 500))
+WRITE_FLUSH_INTERVAL = float(os.environ.get('WRITE_FLUSH_INTERVAL', 2))
+WRITE_LOCK_TIMEOUT = 60
+
+CHANNELS_CACHE_TTL = int(os.environ.get('CHANNELS_CACHE_TTL', 24 * 60 * 60))
 
 
 class UserStates(enum.Enum):
@@ -35,6 +135,7 @@ class UserStates(enum.Enum):
     SELECT_PLACE_TO = 'select_place_to'
     SELECT_DATE_FROM = 'select_date_from'
     SELECT_DATE_TO = 'select_date_to'
+    SELECT_STAY = 'select_stay'
     SEARCH_SUCCESS = 'search_success'
     SEARCH_FAIL = 'search_fail'
 
@@ -43,71 +144,178 @@ class UserStates(enum.Enum):
         return [v.value for k, v in cls.__members__.items()]
 
 
-Country = collections.namedtuple('City', 'name id')
-City = collections.namedtuple('City', 'name id')
+Country = collections.namedtuple('Country', 'name id')
+City = collections.namedtuple('City', 'name id country_id')
 Flight = collections.namedtuple('Flight', 'place_from place_to price_from '
                                           'date carrier')
 
 
+Leg = collections.namedtuple('Leg', 'origin destination carrier departure')
+Option = collections.namedtuple('Option', 'price outbound inbound')
+
+
+class Quote:
+    __slots__ = ('price', 'outbound', 'inbound')
+
+    def __init__(self, price, outbound: Leg=None, inbound: Leg=None):
+        self.price = price
+        self.outbound = outbound
+        self.inbound = inbound
+
+
 class Ticket:
-    def __init__(self, data):
-        self.data = data
-        self.outbound = None
-        self.inbound = None
+    def __init__(self, data=None, options: int=TICKET_OPTIONS):
+        self.places = {}
+        self.carriers = {}
+        self.round_trips = []
+        self.outbounds = []
+        self.inbounds = []
         self.url = None
         self.message_id = None
+        self.set_options([])
 
-        self.fill_from_data()
+        if data is not None:
+            self.fill_from_data(data)
+            self.set_options(self.cheapest(options))
 
-    def get_place(self, place_id: str):
-        return [
-            p for p in self.data['Places']
-            if str(p['PlaceId']) == str(place_id)
-        ][0]
+    def set_options(self, options):
+        self.options = options
+        best = self.options[0] if self.options else None
+        self.outbound = best.outbound if best else None
+        self.inbound = best.inbound if best else None
 
-    def get_carrier(self, carrier_id: str):
-        return [
-            c for c in self.data['Carriers']
-            if str(c['CarrierId']) == str(carrier_id)
-        ][0]
-
-    def fill_from_data(self):
-        outbounds = [q for q in self.data['Quotes'] if 'OutboundLeg' in q]
-        if outbounds:
-            outbound = outbounds[0]
-            place_from = self.get_place(outbound['OutboundLeg']['OriginId'])
-            place_to = self.get_place(outbound['OutboundLeg']['DestinationId'])
-            carrier = self.get_carrier(outbound['OutboundLeg']['CarrierIds'][0])
-
-            self.outbound = Flight(
-                place_from['Name'],
-                place_to['Name'],
-                outbound['MinPrice'],
-                datetime.datetime.strptime(
-                    outbound['OutboundLeg']['DepartureDate'],
-                    SKYSCANNER_DATETIME_FORMAT,
-                ).date(),
-                carrier['Name'],
+    @staticmethod
+    def dump_flight(flight: Flight):
+        if flight is None:
+            return
+        return flight._replace(date=flight.date.strftime(
+            SKYSCANNER_DATE_FORMAT,
+        ))
+
+    @staticmethod
+    def load_flight(data):
+        if data is None:
+            return
+        flight = Flight(*data)
+        return flight._replace(date=datetime.datetime.strptime(
+            flight.date,
+            SKYSCANNER_DATE_FORMAT,
+        ).date())
+
+    def dumps(self):
+        """The offered options, url and message id, without the payload."""
+        return json.dumps({
+            'options': [
+                (o.price, self.dump_flight(o.outbound),
+                 self.dump_flight(o.inbound))
+                for o in self.options
+            ],
+            'url': self.url,
+            'message_id': self.message_id,
+        }, ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, raw):
+        data = json.loads(raw)
+        ticket = cls()
+        ticket.url = data['url']
+        ticket.message_id = data['message_id']
+        ticket.set_options([
+            Option(price, cls.load_flight(outbound), cls.load_flight(inbound))
+            for price, outbound, inbound in data['options']
+        ])
+        return ticket
+
+    @property
+    def price(self):
+        return self.options[0].price if self.options else None
+
+    def get_place(self, place_id):
+        return self.places[place_id]
+
+    def get_carrier(self, carrier_id):
+        return self.carriers[carrier_id]
+
+    @staticmethod
+    def make_leg(data: dict):
+        if data is None:
+            return
+        return Leg(
+            data['OriginId'],
+            data['DestinationId'],
+            data['CarrierIds'][0] if data['CarrierIds'] else None,
+            data['DepartureDate'],
+        )
+
+    def fill_from_data(self, data: dict):
+        self.places = {p['PlaceId']: p['Name'] for p in data['Places']}
+        self.carriers = {c['CarrierId']: c['Name'] for c in data['Carriers']}
+
+        for quote in data['Quotes']:
+            quote = Quote(
+                quote['MinPrice'],
+                self.make_leg(quote.get('OutboundLeg')),
+                self.make_leg(quote.get('InboundLeg')),
             )
+            if quote.outbound and quote.inbound:
+                self.round_trips.append(quote)
+            elif quote.outbound:
+                self.outbounds.append(quote)
+            elif quote.inbound:
+                self.inbounds.append(quote)
 
-        inbounds = [q for q in self.data['Quotes'] if 'InboundLeg' in q]
-        if inbounds:
-            inbound = inbounds[0]
-            place_from = self.get_place(inbound['InboundLeg']['OriginId'])
-            place_to = self.get_place(inbound['InboundLeg']['DestinationId'])
-            carrier = self.get_carrier(inbound['InboundLeg']['CarrierIds'][0])
-
-            self.inbound = Flight(
-                place_from['Name'],
-                place_to['Name'],
-                inbound['MinPrice'],
-                datetime.datetime.strptime(
-                    inbound['InboundLeg']['DepartureDate'],
-                    SKYSCANNER_DATETIME_FORMAT,
-                ).date(),
-                carrier['Name'],
+    def make_flight(self, leg: Leg, price):
+        if leg is None:
+            return
+        return Flight(
+            self.get_place(leg.origin),
+            self.get_place(leg.destination),
+            price,
+            datetime.datetime.strptime(
+                leg.departure,
+                SKYSCANNER_DATETIME_FORMAT,
+            ).date(),
+            self.carriers.get(leg.carrier, ''),
+        )
+
+    def cheapest(self, n: int):
+        """Cheapest ``n`` outbound/inbound combinations sorted by price.
+
+        A combination is either a round trip quote or an outbound and an
+        inbound one way quote. Only the ``n`` cheapest quotes of each kind
+        can take part in the result, so large payloads are not paired.
+        """
+        by_price = operator.attrgetter('price')
+        candidates = [
+            (q.price, q.outbound, q.inbound, q.price, q.price)
+            for q in heapq.nsmallest(n, self.round_trips, key=by_price)
+        ]
+
+        outbounds = heapq.nsmallest(n, self.outbounds, key=by_price)
+        inbounds = heapq.nsmallest(n, self.inbounds, key=by_price)
+        if outbounds and inbounds:
+            candidates.extend(
+                (o.price + i.price, o.outbound, i.inbound, o.price, i.price)
+                for o in outbounds
+                for i in inbounds
+                if o.outbound.departure <= i.inbound.departure
+            )
+        elif not candidates:
+            candidates.extend(
+                (q.price, q.outbound, q.inbound, q.price, q.price)
+                for q in outbounds or inbounds
             )
 
+        return [
+            Option(
+                price,
+                self.make_flight(outbound, outbound_price),
+                self.make_flight(inbound, inbound_price),
+            )
+            for price, outbound, inbound, outbound_price, inbound_price in
+            heapq.nsmallest(n, candidates, key=operator.itemgetter(0))
+        ]
+
     def message(self):
         message = 'Информация о рейсе:\n'
         if self.outbound:
@@ -125,4 +333,13 @@ class Ticket:
                    'Цена: от {} руб.\n' \
                    'Дата отправления: {}\n' \
                    'Авиокомпания: {}\n'.format(*self.inbound)
+
+        if len(self.options) > 1:
+            message += 'Другие варианты:\n'
+            for option in self.options[1:]:
+                message += '{} - {}: от {} руб.\n'.format(
+                    option.outbound.date if option.outbound else '',
+                    option.inbound.date if option.inbound else '',
+                    option.price,
+                )
         return message
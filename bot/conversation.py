@@ -0,0 +1,563 @@
+"""Conversation of the bot, written once for every execution mode.
+
+Handlers are coroutines of ``Conversation``, they reach Telegram, the
+sessions, Skyscanner and the blocking stores through its ``services``.
+``AsyncServices`` of ``bot.aio`` await them on the event loop. The
+``BlockingServices`` below call them directly: their coroutines never
+suspend, so ``complete`` runs a handler to its end in the calling thread,
+without an event loop.
+"""
+import datetime
+import collections
+
+from telebot import apihelper, types
+
+from .constants import UserStates, USER_DATE_FORMAT, USER_MONTH_FORMAT, \
+    FLEXIBLE_MAX_STAY, ANYWHERE, ANYWHERE_NAMES, INLINE_CACHE_TIME
+from .anywhere import destinations_message
+from .broadcast import summarize, to_telegram_error
+from .channels import channel_store
+from .errors import SkyscannerApiUnavailable, TelegramApiError
+from .inline import InlineSearch
+from .instrument import observe_handler
+from .router import StateRouter
+from .utils import Channel, Lazy
+from .watch import make_route
+from .writes import writes
+
+
+router = StateRouter()
+# Command -> handler, in the order they are declared.
+commands = collections.OrderedDict()
+
+
+def command(*names):
+    def decorator(func):
+        for name in names:
+            commands[name] = func
+        return func
+    return decorator
+
+
+def complete(coroutine):
+    """Result of a coroutine that never suspends."""
+    try:
+        coroutine.send(None)
+    except StopIteration as e:
+        return e.value
+    coroutine.close()
+    raise RuntimeError('{} suspended outside of an event loop'.format(
+        coroutine,
+    ))
+
+
+class BlockingServices:
+    """Services of the threaded modes on telebot and the blocking clients."""
+
+    def __init__(self, bot, sessions, api, broadcaster):
+        self.bot = bot
+        self.sessions = sessions
+        self.api = api
+        self.broadcaster = broadcaster
+
+    @property
+    def geo(self):
+        return self.api.geo
+
+    async def send_message(self,
+                           chat_id,
+                           text: str,
+                           reply_markup=None,
+                           disable_notification: bool=None):
+        return self.bot.send_message(
+            chat_id,
+            text,
+            reply_markup=reply_markup,
+            disable_notification=disable_notification,
+        )
+
+    async def get_chat(self, chat_id):
+        try:
+            return self.bot.get_chat(chat_id)
+        except apihelper.ApiException as e:
+            raise to_telegram_error(e)
+
+    async def answer_inline_query(self,
+                                  inline_query_id,
+                                  results,
+                                  cache_time: int=None,
+                                  next_offset: str=None):
+        return self.bot.answer_inline_query(
+            inline_query_id,
+            results,
+            cache_time=cache_time,
+            next_offset=next_offset,
+        )
+
+    async def broadcast(self, chat_ids, text: str, reply_markup=None):
+        return self.broadcaster.broadcast(
+            chat_ids,
+            lambda chat_id: self.bot.send_message(
+                chat_id, text, reply_markup=reply_markup,
+            ),
+        )
+
+    async def run_blocking(self, func, *args):
+        return func(*args)
+
+    async def get_session(self, user_id):
+        return self.sessions.get(user_id)
+
+    def lock(self, u):
+        # Updates of a user may be handled by several threads at once.
+        return u.lock
+
+    async def flush(self, u):
+        u.flush()
+
+    async def clear(self, u):
+        u.clear()
+
+    async def search(self, u):
+        return self.api.search(u)
+
+    async def search_flexible(self, u, stay: int):
+        return self.api.search_flexible(u, stay)
+
+    async def search_anywhere(self, u):
+        return self.api.search_anywhere(u)
+
+
+def booking_button(ticket):
+    btn = types.InlineKeyboardMarkup()
+    btn.add(types.InlineKeyboardButton('Бронировать', url=ticket.url))
+    return btn
+
+
+class Conversation:
+    def __init__(self, services, watcher):
+        self.services = services
+        self.watcher = watcher
+        self.inline_search = Lazy(lambda: InlineSearch(services.geo))
+
+    async def reply(self, message, text: str, **kwargs):
+        return await self.services.send_message(
+            message.chat.id, text, **kwargs
+        )
+
+    async def notify_price_drop(self, chat_id, ticket):
+        await self.services.send_message(
+            chat_id,
+            'Цена на отслеживаемый рейс снизилась до {} руб.\n{}'.format(
+                ticket.price, ticket.message(),
+            ),
+            reply_markup=booking_button(ticket),
+        )
+
+    @command('start')
+    async def welcome(self, message):
+        await self.reply(message, 'Добро пожаловать!')
+        await self.services.run_blocking(writes.add_user,
+                                         message.from_user.id)
+        u = await self.services.get_session(message.from_user.id)
+        await self.services.clear(u)
+        await self.select_country_from(message, u)
+
+    @command('new')
+    async def new(self, message):
+        u = await self.services.get_session(message.from_user.id)
+        await self.services.clear(u)
+        await self.select_country_from(message, u)
+
+    @command('list_channels')
+    async def list_channels(self, message):
+        channels = await self.services.run_blocking(channel_store.get,
+                                                    message.from_user.id)
+        if not channels:
+            msg = 'Список ваших каналов пуст, вы можете добавить канал ' \
+                  'с помощью команды /add_channel @your_channel_name'
+        else:
+            msg = 'Список ваших каналов:\n' + '\n'.join(channels)
+
+        await self.reply(message, msg)
+
+    @command('add_channel')
+    async def add_channel(self, message):
+        try:
+            channel_name = message.text.strip().split()[1]
+            if '@' not in channel_name:
+                channel_name = '@' + channel_name
+
+            await self.services.get_chat(channel_name)
+        except TelegramApiError:
+            return await self.reply(
+                message,
+                'Произошла ошибка при добавлении канала, возможно вы '
+                'пытаетесь добавить не существующий или приватный канал',
+            )
+        except (KeyError, IndexError):
+            return await self.reply(
+                message,
+                'Не верный формат комнады, пример: '
+                '/add_channel @your_channel_name'
+            )
+
+        await self.reply(
+            message,
+            'Вы успешно добавили канал, для репоста в ваш канал вам '
+            'необходимо дать админ права данному боту в настройках канала',
+        )
+        await self.services.run_blocking(channel_store.add,
+                                         message.from_user.id, channel_name)
+
+    @command('delete_channel')
+    async def delete_channel(self, message):
+        try:
+            channel_name = message.text.strip().split()[1]
+            await self.services.run_blocking(channel_store.delete,
+                                             message.from_user.id,
+                                             channel_name)
+        except (KeyError, IndexError):
+            return await self.reply(
+                message,
+                'Не верный формат команды, пример: '
+                '/delete_channel @your_channel_name'
+            )
+        except Channel.DoesNotExist:
+            return await self.reply(message, 'Канал не найден')
+
+    @command('to_channels')
+    async def to_my_channels(self, message):
+        state_user = await self.services.get_session(message.from_user.id)
+        if message.reply_to_message is None:
+            return await self.reply(
+                message,
+                'Вы должны сделать reply на сообщение которое хотите '
+                'отправить',
+            )
+
+        channels = await self.services.run_blocking(channel_store.get,
+                                                    message.from_user.id)
+        if not channels:
+            return await self.reply(
+                message,
+                'Список ваших каналов пуст, вы можете добавить канал '
+                'с помощью команды /add_channel @your_channel_name',
+            )
+
+        ticket = state_user.ticket
+        if ticket is None:
+            return await self.reply(
+                message,
+                'У вас нет активного тикета, повторите поиск',
+            )
+
+        if message.reply_to_message.message_id != ticket.message_id:
+            return await self.reply(
+                message,
+                'Сообщение не найдено, повторите поиск',
+            )
+
+        results = await self.services.broadcast(
+            channels, ticket.message(), reply_markup=booking_button(ticket),
+        )
+        await self.reply(message, summarize(results))
+
+    @command('watch')
+    async def watch(self, message):
+        u = await self.services.get_session(message.from_user.id)
+        ticket = u.ticket
+        if ticket is None:
+            return await self.reply(
+                message,
+                'У вас нет активного тикета, повторите поиск',
+            )
+
+        try:
+            parts = message.text.strip().split()
+            threshold = int(parts[1]) if len(parts) > 1 else ticket.price
+        except ValueError:
+            return await self.reply(
+                message,
+                'Не верный формат команды, пример: /watch 5000',
+            )
+
+        await self.services.run_blocking(
+            self.watcher.watch, make_route(u), message.from_user.id,
+            message.chat.id, threshold,
+        )
+        await self.reply(
+            message,
+            'Мы сообщим вам, когда цена на рейс станет ниже {} руб., '
+            'для отмены используйте команду /unwatch'.format(threshold),
+        )
+
+    @command('unwatch')
+    async def unwatch(self, message):
+        if not await self.services.run_blocking(self.watcher.unwatch,
+                                                message.from_user.id):
+            return await self.reply(message, 'У вас нет отслеживаемых рейсов')
+
+        await self.reply(message, 'Отслеживание цен отменено')
+
+    @router.state(UserStates.SELECT_COUNTRY_FROM)
+    async def select_country_from(self, message, u):
+        if message.text in ('/new', '/start'):
+            return await self.reply(
+                message,
+                'Введите название страны из которой вы отправляетесь'
+            )
+
+        founded_countries = self.services.geo.search_countries(message.text)
+        if not founded_countries:
+            return await self.reply(
+                message,
+                'Страны с таким названием не найдено, попробуйте еще раз',
+            )
+
+        u.country_from = founded_countries[0].id
+        u.to_select_place_from()
+        await self.services.flush(u)
+        await self.reply(message, 'Введите название города отправления')
+
+    @router.state(UserStates.SELECT_PLACE_FROM)
+    async def select_place_from(self, message, u):
+        founded_cities = self.services.geo.search_cities(
+            message.text,
+            country=u.country_from,
+        )
+        if not founded_cities:
+            return await self.reply(
+                message,
+                'Города с таким названием не найдено, попробуйте еще раз',
+            )
+
+        u.place_from = founded_cities[0].id
+        u.to_select_place_to()
+        await self.services.flush(u)
+        await self.reply(
+            message,
+            'Введите название города прибытия или "везде", чтобы найти '
+            'самые дешевые направления',
+        )
+
+    @router.state(UserStates.SELECT_PLACE_TO)
+    async def select_place_to(self, message, u):
+        if message.text.strip().lower() in ANYWHERE_NAMES:
+            place_to = ANYWHERE
+        else:
+            founded_cities = self.services.geo.search_cities(message.text)
+            if not founded_cities:
+                return await self.reply(
+                    message,
+                    'Города с таким названием не найдено, попробуйте еще раз'
+                )
+            place_to = founded_cities[0].id
+
+        u.place_to = place_to
+        u.to_select_date_from()
+        await self.services.flush(u)
+        await self.reply(
+            message,
+            'Введите дату вылета в формате DD.MM.YYYY или месяц вылета '
+            'в формате MM.YYYY, если ваши даты гибкие'
+        )
+
+    @router.state(UserStates.SELECT_DATE_FROM)
+    async def select_date_from(self, message, u):
+        try:
+            date = datetime.datetime.strptime(
+                message.text,
+                USER_DATE_FORMAT,
+            ).date()
+        except ValueError:
+            return await self.select_month(message, u)
+
+        u.date_from = date
+        u.to_select_date_to()
+        await self.services.flush(u)
+        await self.reply(
+            message,
+            'Введите дату окончания вашей поездки в формате DD.MM.YYYY',
+        )
+
+    async def select_month(self, message, u):
+        if u.place_to == ANYWHERE:
+            return await self.reply(
+                message,
+                'Гибкие даты недоступны при поиске по всем направлениям, '
+                'введите дату в формате DD.MM.YYYY',
+            )
+
+        try:
+            month = datetime.datetime.strptime(
+                message.text,
+                USER_MONTH_FORMAT,
+            ).date()
+        except ValueError:
+            return await self.reply(
+                message,
+                'Не верный формат даты, попробуйте еще раз'
+            )
+
+        if month < datetime.date.today().replace(day=1):
+            return await self.reply(
+                message,
+                'Этот месяц уже прошел, попробуйте еще раз',
+            )
+
+        u.date_from = month
+        u.to_select_stay()
+        await self.services.flush(u)
+        await self.reply(message, 'Введите длительность поездки в днях')
+
+    @router.state(UserStates.SELECT_STAY)
+    async def select_stay(self, message, u):
+        try:
+            stay = int(message.text)
+        except ValueError:
+            stay = 0
+        if not 0 < stay <= FLEXIBLE_MAX_STAY:
+            return await self.reply(
+                message,
+                'Введите число дней от 1 до {}'.format(FLEXIBLE_MAX_STAY),
+            )
+
+        try:
+            ticket = await self.services.search_flexible(u, stay)
+        except SkyscannerApiUnavailable:
+            return await self.reply(
+                message,
+                'Сервис поиска временно недоступен, '
+                'попробуйте отправить длительность еще раз позже',
+            )
+
+        await self.show_search_result(message, u, ticket)
+
+    @router.state(UserStates.SELECT_DATE_TO)
+    async def select_date_to(self, message, u):
+        try:
+            date = datetime.datetime.strptime(
+                message.text,
+                USER_DATE_FORMAT,
+            ).date()
+        except ValueError:
+            return await self.reply(
+                message,
+                'Не верный формат даты, попробуйте еще раз'
+            )
+
+        if date < u.date_from:
+            return await self.reply(
+                message,
+                'Дата окончания поездки должна быть больше даты начала '
+                'поездки',
+            )
+
+        u.date_to = date
+        await self.services.flush(u)
+
+        if u.place_to == ANYWHERE:
+            return await self.search_anywhere(message, u)
+
+        try:
+            ticket = await self.services.search(u)
+        except SkyscannerApiUnavailable:
+            return await self.reply(
+                message,
+                'Сервис поиска временно недоступен, '
+                'попробуйте отправить дату еще раз позже',
+            )
+
+        await self.show_search_result(message, u, ticket)
+
+    async def search_anywhere(self, message, u):
+        try:
+            destinations = await self.services.search_anywhere(u)
+        except SkyscannerApiUnavailable:
+            return await self.reply(
+                message,
+                'Сервис поиска временно недоступен, '
+                'попробуйте отправить дату еще раз позже',
+            )
+
+        if destinations:
+            u.to_search_success()
+            await self.services.flush(u)
+            await self.reply(message, destinations_message(destinations))
+        else:
+            u.to_search_fail()
+            await self.services.flush(u)
+            await self.reply(
+                message,
+                'К сожалению по вашему запросу ничего не найдено',
+            )
+        await self.after_search(message, u)
+
+    async def show_search_result(self, message, u, ticket):
+        if ticket:
+            u.to_search_success()
+            await self.reply(
+                message,
+                'По вашему запросу найден следующий рейс',
+            )
+
+            msg = await self.reply(
+                message,
+                ticket.message(),
+                reply_markup=booking_button(ticket),
+                disable_notification=True,
+            )
+            # Stored with its message id, /to_channels may run in any
+            # worker.
+            ticket.message_id = msg.message_id
+            u.ticket = ticket
+            # The found dates, which can differ from the requested ones
+            # for shifted windows and flexible stays, so /watch follows
+            # this very trip.
+            u.date_from = ticket.outbound.date
+            u.date_to = ticket.inbound.date
+            await self.services.flush(u)
+        else:
+            u.to_search_fail()
+            await self.services.flush(u)
+            await self.reply(
+                message,
+                'К сожалению по вашему запросу ничего не найдено',
+            )
+
+        if ticket and await self.services.run_blocking(channel_store.get,
+                                                       message.from_user.id):
+            await self.reply(
+                message,
+                'Для отправки сообщения в ваши каналы, '
+                'выберите сообщение и введите команду /to_channels',
+            )
+        await self.after_search(message, u)
+
+    @router.state(UserStates.SEARCH_FAIL, UserStates.SEARCH_SUCCESS)
+    async def after_search(self, message, u):
+        msg = 'Для перехода в начало поиска используйте комнаду /new'
+        if u.state == UserStates.SEARCH_SUCCESS.value and \
+                u.place_to != ANYWHERE:
+            msg += ', для отслеживания цены на рейс - /watch'
+        await self.reply(message, msg)
+
+    async def suggest_places(self, query):
+        results, next_offset = self.inline_search.answer(query.query,
+                                                         query.offset)
+        await self.services.answer_inline_query(
+            query.id,
+            results,
+            cache_time=INLINE_CACHE_TIME,
+            next_offset=next_offset,
+        )
+
+    async def route(self, message):
+        """Pass the message to the handler of the user state."""
+        u = await self.services.get_session(message.from_user.id)
+        with self.services.lock(u):
+            handler = router.resolve(u.state)
+            if handler is not None:
+                with observe_handler(handler.__name__):
+                    await handler(self, message, u)
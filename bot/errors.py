@@ -4,3 +4,19 @@ class BaseSkyscannerApiException(Exception):
 
 class SkyscannerApiNotFound(BaseSkyscannerApiException):
     pass
+
+
+class SkyscannerApiUnavailable(BaseSkyscannerApiException):
+    pass
+
+
+class MachineError(Exception):
+    pass
+
+
+class TelegramApiError(Exception):
+    def __init__(self, description, error_code=None, retry_after=None):
+        super().__init__(description)
+        self.description = description
+        self.error_code = error_code
+        self.retry_after = retry_after
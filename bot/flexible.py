@@ -0,0 +1,153 @@
+"""Cheapest trip of a given length within a month.
+
+Browse quotes of a whole month are laid out as a price matrix indexed by
+the outbound and the inbound day, the trips of one length are a diagonal
+of it, so the cheapest ones are found without a request per date pair.
+"""
+import datetime
+
+import numpy
+
+from .constants import Option, Ticket, SKYSCANNER_DATETIME_FORMAT, \
+    TICKET_OPTIONS
+
+
+def month_days(month: datetime.date):
+    """First day and length of the month of ``month``."""
+    first = month.replace(day=1)
+    following = (first + datetime.timedelta(days=31)).replace(day=1)
+    return first, (following - first).days
+
+
+def stay_months(month: datetime.date, stay: int):
+    """Months the inbound flights of ``stay`` day trips fall into.
+
+    >>> [m.month for m in stay_months(datetime.date(2027, 1, 1), 29)]
+    [1, 2, 3]
+    """
+    first, days = month_days(month)
+    inbound = (first + datetime.timedelta(days=stay)).replace(day=1)
+    last = first + datetime.timedelta(days=days - 1 + stay)
+    months = []
+    while inbound <= last:
+        months.append(inbound)
+        inbound = month_days(inbound + datetime.timedelta(days=31))[0]
+    return months
+
+
+def merge_quotes(payloads):
+    """One browsequotes payload out of several."""
+    places = {}
+    carriers = {}
+    quotes = []
+    for data in payloads:
+        places.update((p['PlaceId'], p) for p in data.get('Places', []))
+        carriers.update((c['CarrierId'], c) for c in data.get('Carriers', []))
+        quotes.extend(data.get('Quotes', []))
+    return {
+        'Places': list(places.values()),
+        'Carriers': list(carriers.values()),
+        'Quotes': quotes,
+    }
+
+
+class PriceCalendar:
+    """Prices of the trips starting in the month of ``month``.
+
+    Day ``i`` of both axes is ``i`` days after the first of the month,
+    the inbound axis is ``stay`` days longer than the month.
+    """
+
+    def __init__(self, ticket: Ticket, month: datetime.date, stay: int):
+        self.ticket = ticket
+        self.first, self.days = month_days(month)
+        self.stay = stay
+        self.size = self.days + stay
+        self.round_trips = {}
+        self.outbounds = {}
+        self.inbounds = {}
+        self.prices = self.build()
+
+    def day(self, leg):
+        departure = datetime.datetime.strptime(
+            leg.departure,
+            SKYSCANNER_DATETIME_FORMAT,
+        ).date()
+        day = (departure - self.first).days
+        return day if 0 <= day < self.size else None
+
+    @staticmethod
+    def keep_cheapest(quotes: dict, key, quote):
+        if key is not None and (key not in quotes or
+                                quote.price < quotes[key].price):
+            quotes[key] = quote
+
+    def build(self):
+        for quote in self.ticket.round_trips:
+            days = (self.day(quote.outbound), self.day(quote.inbound))
+            if None not in days:
+                self.keep_cheapest(self.round_trips, days, quote)
+        for quote in self.ticket.outbounds:
+            self.keep_cheapest(self.outbounds, self.day(quote.outbound), quote)
+        for quote in self.ticket.inbounds:
+            self.keep_cheapest(self.inbounds, self.day(quote.inbound), quote)
+
+        outbound = self.to_array(self.outbounds)
+        inbound = self.to_array(self.inbounds)
+        prices = outbound[:, None] + inbound[None, :]
+
+        if self.round_trips:
+            days = numpy.array(list(self.round_trips), dtype=int)
+            round_trips = numpy.array(
+                [q.price for q in self.round_trips.values()], dtype=float,
+            )
+            cells = (days[:, 0], days[:, 1])
+            prices[cells] = numpy.minimum(prices[cells], round_trips)
+        return prices
+
+    def to_array(self, quotes: dict):
+        prices = numpy.full(self.size, numpy.inf)
+        if quotes:
+            prices[list(quotes)] = [q.price for q in quotes.values()]
+        return prices
+
+    def cheapest(self, n: int=TICKET_OPTIONS, since: datetime.date=None):
+        """Outbound days of the ``n`` cheapest trips, cheapest first."""
+        # Diagonal ``stay`` holds the trips leaving on day i, i < days.
+        prices = numpy.diagonal(self.prices, offset=self.stay).copy()
+        if since is not None:
+            prices[:max(0, (since - self.first).days)] = numpy.inf
+
+        n = min(n, len(prices))
+        days = numpy.argpartition(prices, n - 1)[:n]
+        days = days[numpy.argsort(prices[days], kind='stable')]
+        return [int(day) for day in days if numpy.isfinite(prices[day])]
+
+    def make_option(self, day: int):
+        outbound, inbound = day, day + self.stay
+        round_trip = self.round_trips.get((outbound, inbound))
+        one_ways = (self.outbounds.get(outbound), self.inbounds.get(inbound))
+
+        if round_trip is not None and (
+                None in one_ways or
+                round_trip.price <= one_ways[0].price + one_ways[1].price):
+            return Option(
+                round_trip.price,
+                self.ticket.make_flight(round_trip.outbound, round_trip.price),
+                self.ticket.make_flight(round_trip.inbound, round_trip.price),
+            )
+
+        outbound, inbound = one_ways
+        return Option(
+            outbound.price + inbound.price,
+            self.ticket.make_flight(outbound.outbound, outbound.price),
+            self.ticket.make_flight(inbound.inbound, inbound.price),
+        )
+
+    def make_ticket(self, n: int=TICKET_OPTIONS, since: datetime.date=None):
+        """Ticket offering the cheapest trips, None when there are none."""
+        days = self.cheapest(n, since)
+        if not days:
+            return
+        self.ticket.set_options([self.make_option(day) for day in days])
+        return self.ticket
@@ -0,0 +1,281 @@
+import json
+import time
+import logging
+import threading
+
+from .errors import SkyscannerApiUnavailable
+from .search import PlaceIndex
+from .snapshot import GeoSnapshot, SnapshotError
+from .constants import Country, City, GEO_CACHE_KEY, GEO_CACHE_TTL, \
+    GEO_CACHE_STALE_TTL, GEO_CACHE_LOCK_TIMEOUT, GEO_SNAPSHOT_PATH, \
+    GEO_REFRESH_BACKOFF, GEO_REFRESH_MAX_BACKOFF
+
+
+logger = logging.getLogger(__name__)
+
+
+def is_geo_tree(data):
+    return isinstance(data, dict) and 'Continents' in data
+
+
+class IndexMap(dict):
+    """Index of each key made by ``factory`` on first lookup.
+
+    Most countries are never searched, so their indexes are not built on
+    load. ``factory`` raises ``KeyError`` for unknown keys.
+    """
+
+    def __init__(self, factory):
+        super().__init__()
+        self.factory = factory
+
+    def __missing__(self, key):
+        index = self[key] = self.factory(key)
+        return index
+
+
+class GeoCatalog:
+    """Shared copy of the Skyscanner geo tree.
+
+    The tree is kept in process memory and in redis. Readers always get
+    the last known copy; once it is older than ``ttl`` a single background
+    refresh is started (stale-while-revalidate). Only the very first call
+    of a cold process with an empty redis waits for the download.
+
+    With ``snapshot_path`` the catalog is served from the mapped snapshot
+    file instead, see ``bot.snapshot``, and refreshed by reopening the file
+    once it is rebuilt. Redis and Skyscanner are only used when the file
+    cannot be read.
+    """
+
+    def __init__(self,
+                 fetch,
+                 redis,
+                 key: str=GEO_CACHE_KEY,
+                 ttl: int=GEO_CACHE_TTL,
+                 stale_ttl: int=GEO_CACHE_STALE_TTL,
+                 snapshot_path: str=GEO_SNAPSHOT_PATH):
+        self.fetch = fetch
+        self.redis = redis
+        self.key = key
+        self.lock_key = '{}_lock'.format(key)
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.snapshot_path = snapshot_path
+
+        self.fetched_at = None
+        self.snapshot = None
+        self.countries = ()
+        self.cities = ()
+        self.country_names = {}
+        self.country_index = PlaceIndex(())
+        self.city_index = PlaceIndex(())
+        self.city_index_by_country = IndexMap(lambda key: PlaceIndex(()))
+
+        self._lock = threading.Lock()
+        self._refreshing = threading.Event()
+        self._refresher = None
+        self._next_attempt = 0
+        self._backoff = GEO_REFRESH_BACKOFF
+
+    @property
+    def loaded(self):
+        return self.fetched_at is not None
+
+    def is_stale(self):
+        return self.loaded and time.time() - self.fetched_at > self.ttl
+
+    def get_countries(self):
+        self.ensure_loaded()
+        return self.countries
+
+    def get_cities(self):
+        self.ensure_loaded()
+        return self.cities
+
+    def search_countries(self, query: str, **kwargs):
+        self.ensure_loaded()
+        return self.country_index.search(query, **kwargs)
+
+    def search_cities(self, query: str, country: str=None, **kwargs):
+        self.ensure_loaded()
+        if country is None:
+            return self.city_index.search(query, **kwargs)
+
+        try:
+            index = self.city_index_by_country[country]
+        except KeyError:
+            return []
+        return index.search(query, **kwargs)
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            with self._lock:
+                if not self.loaded:
+                    self.load()
+        if self.is_stale():
+            self.refresh_async()
+
+    def load(self):
+        if not self.load_from_snapshot() and not self.load_from_redis():
+            self.refresh()
+
+    def load_from_snapshot(self):
+        if not self.snapshot_path:
+            return False
+
+        try:
+            snapshot = GeoSnapshot(self.snapshot_path)
+        except (OSError, SnapshotError):
+            logger.exception('Failed to open the geo snapshot')
+            return False
+        if not self.loaded or snapshot.fetched_at > self.fetched_at:
+            self.publish_snapshot(snapshot)
+        return True
+
+    def load_from_redis(self):
+        raw = self.redis.get(self.key)
+        if raw is None:
+            return False
+
+        envelope = json.loads(raw.decode())
+        # Error bodies stored before they were rejected on fetch.
+        if not is_geo_tree(envelope['data']):
+            return False
+        # The copy this process already has is not indexed again.
+        if not self.loaded or envelope['fetched_at'] > self.fetched_at:
+            self.set(envelope['data'], envelope['fetched_at'])
+        return True
+
+    def refresh(self):
+        # Several processes share one redis copy, so only the lock holder
+        # downloads the tree, the others pick it up from redis.
+        got_lock = self.redis.set(
+            self.lock_key, 1, nx=True, ex=GEO_CACHE_LOCK_TIMEOUT,
+        )
+        if not got_lock and self.loaded:
+            return
+
+        try:
+            data = self.fetch()
+            # Error bodies such as ValidationErrors of a bad key are
+            # returned as data, they must not reach the shared copy.
+            if not is_geo_tree(data):
+                raise SkyscannerApiUnavailable(
+                    'Unexpected geo response: {:.200}'.format(
+                        json.dumps(data),
+                    )
+                )
+            fetched_at = time.time()
+            self.set(data, fetched_at)
+            self.redis.set(
+                self.key,
+                json.dumps({'fetched_at': fetched_at, 'data': data}),
+                ex=self.stale_ttl,
+            )
+        finally:
+            if got_lock:
+                self.redis.delete(self.lock_key)
+
+    def refresh_async(self):
+        if self._refreshing.is_set() or time.monotonic() < self._next_attempt:
+            return
+
+        self._refreshing.set()
+        thread = threading.Thread(target=self._refresh_in_background)
+        thread.daemon = True
+        thread.start()
+
+    def _refresh_in_background(self):
+        try:
+            if self.load_from_snapshot():
+                if self.is_stale():
+                    logger.warning('Geo snapshot %s is stale',
+                                   self.snapshot_path)
+            # Another process could have refreshed redis in the meantime.
+            elif not self.load_from_redis() or self.is_stale():
+                self.refresh()
+        except Exception:
+            logger.exception('Geo catalog refresh failed')
+        finally:
+            # Still stale when the fetch failed or another process holds
+            # the lock, the next attempt waits instead of every reader
+            # starting one.
+            if self.is_stale():
+                self._next_attempt = time.monotonic() + self._backoff
+                self._backoff = min(self._backoff * 2, GEO_REFRESH_MAX_BACKOFF)
+            else:
+                self._next_attempt = 0
+                self._backoff = GEO_REFRESH_BACKOFF
+            self._refreshing.clear()
+
+    def set(self, data, fetched_at):
+        countries = []
+        by_country = {}
+        for continent in data['Continents']:
+            for country in continent['Countries']:
+                countries.append(Country(country['Name'], country['Id']))
+                by_country[country['Id']] = [
+                    City(city['Name'], city['Id'], country['Id'])
+                    for city in country['Cities']
+                ]
+        self.publish(countries, by_country, fetched_at)
+
+    def publish(self, countries, by_country, fetched_at):
+        cities = [
+            city for country in countries for city in by_country[country.id]
+        ]
+
+        # Indexes are built before anything is published, so readers keep
+        # using the previous version until the new one is complete.
+        country_index = PlaceIndex(countries)
+        city_index = PlaceIndex(cities)
+        city_index_by_country = IndexMap(
+            lambda key: PlaceIndex(by_country[key]),
+        )
+
+        self.snapshot = None
+        self.countries = tuple(countries)
+        self.cities = tuple(cities)
+        self.country_names = {c.id: c.name for c in countries}
+        self.country_index = country_index
+        self.city_index = city_index
+        self.city_index_by_country = city_index_by_country
+        self.fetched_at = fetched_at
+
+    def publish_snapshot(self, snapshot: GeoSnapshot):
+        # Only the countries are decoded, cities and indexes read the
+        # mapped file.
+        countries = snapshot.countries()
+        positions = {country.id: i for i, country in enumerate(countries)}
+
+        self.snapshot = snapshot
+        self.countries = countries
+        self.cities = snapshot.cities()
+        self.country_names = {c.id: c.name for c in countries}
+        self.country_index = snapshot.country_index()
+        self.city_index = snapshot.city_index()
+        self.city_index_by_country = IndexMap(
+            lambda key: snapshot.country_city_index(positions[key]),
+        )
+        self.fetched_at = snapshot.fetched_at
+
+    def start(self, interval: int=None):
+        """Warm the catalog and keep it fresh from a daemon thread."""
+        if self._refresher is not None:
+            return
+
+        if interval is None:
+            interval = max(self.ttl // 10, 1)
+
+        def run():
+            while True:
+                try:
+                    self.ensure_loaded()
+                except Exception:
+                    logger.exception('Geo catalog warm up failed')
+                time.sleep(interval)
+
+        self._refresher = threading.Thread(target=run)
+        self._refresher.daemon = True
+        self._refresher.start()
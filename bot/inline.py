@@ -0,0 +1,96 @@
+"""Place suggestions for inline queries.
+
+``@bot моск`` lists the countries and cities matching the query, picking
+one sends its name to the chat, which the conversation takes like a
+typed one. The ranked places of a query are kept in an LRU, so the pages
+of popular prefixes are served without searching again.
+"""
+import threading
+import collections
+
+from telebot import types
+
+from . import metrics
+from .search import normalize
+from .constants import City, INLINE_PAGE_SIZE, INLINE_RESULTS_LIMIT, \
+    INLINE_COUNTRIES_LIMIT, INLINE_CACHE_SIZE
+
+
+class InlineSearch:
+    def __init__(self,
+                 geo,
+                 page_size: int=INLINE_PAGE_SIZE,
+                 limit: int=INLINE_RESULTS_LIMIT,
+                 countries_limit: int=INLINE_COUNTRIES_LIMIT,
+                 cache_size: int=INLINE_CACHE_SIZE):
+        self.geo = geo
+        self.page_size = page_size
+        self.limit = limit
+        self.countries_limit = countries_limit
+        self.cache_size = cache_size
+        self._places = collections.OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._places)
+
+    def find(self, query: str):
+        """Countries, then cities matching ``query``, best first."""
+        key = normalize(query)
+        if not key:
+            return ()
+
+        self.geo.ensure_loaded()
+        version = self.geo.fetched_at
+        with self._lock:
+            # Results of a replaced catalog are dropped all at once.
+            if self._version != version:
+                self._places.clear()
+                self._version = version
+            places = self._places.get(key)
+            if places is not None:
+                self._places.move_to_end(key)
+
+        if places is not None:
+            metrics.inline_cache_requests.inc(result='hit')
+            return places
+
+        metrics.inline_cache_requests.inc(result='miss')
+        countries = self.geo.search_countries(key,
+                                              limit=self.countries_limit)
+        cities = self.geo.search_cities(key,
+                                        limit=self.limit - len(countries))
+        places = tuple(countries + cities)
+        with self._lock:
+            if self._version == version:
+                self._places[key] = places
+                while len(self._places) > self.cache_size:
+                    self._places.popitem(last=False)
+        return places
+
+    def page(self, query: str, offset: str=''):
+        """Places at ``offset`` and the offset of the next page."""
+        start = int(offset) if offset.isdigit() else 0
+        places = self.find(query)
+        stop = start + self.page_size
+        return places[start:stop], str(stop) if stop < len(places) else ''
+
+    def make_result(self, place):
+        if isinstance(place, City):
+            kind = 'city'
+            description = self.geo.country_names.get(place.country_id, '')
+        else:
+            kind = 'country'
+            description = 'Страна'
+        return types.InlineQueryResultArticle(
+            '{}:{}'.format(kind, place.id)[:64],
+            place.name,
+            types.InputTextMessageContent(place.name),
+            description=description,
+        )
+
+    def answer(self, query: str, offset: str=''):
+        """Results of the page at ``offset`` and the next offset."""
+        places, next_offset = self.page(query, offset)
+        return [self.make_result(place) for place in places], next_offset
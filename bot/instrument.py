@@ -0,0 +1,52 @@
+"""Timing of the handlers and the database queries."""
+import time
+import contextlib
+
+import telebot
+
+from . import metrics
+from .profiler import profiler
+
+
+@contextlib.contextmanager
+def observe_handler(name: str):
+    with metrics.handler_seconds.time(handler=name):
+        try:
+            yield
+        except Exception:
+            metrics.handler_errors.inc(handler=name)
+            raise
+
+
+class TimedTeleBot(telebot.TeleBot):
+    """TeleBot timing every handler it runs, threaded or not."""
+
+    def _exec_task(self, task, *args, **kwargs):
+        super()._exec_task(self.timed(task), *args, **kwargs)
+
+    @staticmethod
+    def timed(task):
+        name = getattr(task, '__name__', 'handler')
+
+        def run(*args, **kwargs):
+            with profiler.watch(name), observe_handler(name):
+                return task(*args, **kwargs)
+        return run
+
+
+def instrument_database(database):
+    """Time every query of ``database`` by its statement."""
+    execute_sql = database.execute_sql
+
+    def timed(sql, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            return execute_sql(sql, *args, **kwargs)
+        finally:
+            metrics.db_query_seconds.observe(
+                time.monotonic() - started,
+                statement=sql.split(None, 1)[0].upper(),
+            )
+
+    database.execute_sql = timed
+    return database
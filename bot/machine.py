@@ -0,0 +1,83 @@
+from .errors import MachineError
+
+
+class StateMachine:
+    """Transition table shared by all instances of a model class.
+
+    Mirrors the subset of ``transitions.Machine`` the bot relies on:
+    ``to_<state>`` auto transitions from any state plus the declared
+    transitions, where the first matching transition wins. The model only
+    stores its current state in ``model.state``.
+    """
+
+    def __init__(self,
+                 states,
+                 transitions,
+                 initial: str,
+                 auto_transitions: bool=True):
+        self.states = tuple(states)
+        self.initial = initial
+        self.events = {}
+
+        if auto_transitions:
+            for state in self.states:
+                self.add_transition('to_{}'.format(state), '*', state)
+
+        for transition in transitions:
+            self.add_transition(
+                transition['trigger'],
+                transition['source'],
+                transition['dest'],
+            )
+
+    def add_transition(self, trigger: str, source, dest: str):
+        if source == '*':
+            sources = self.states
+        elif isinstance(source, str):
+            sources = (source,)
+        else:
+            sources = source
+
+        table = self.events.setdefault(trigger, {})
+        for state in sources:
+            table.setdefault(state, dest)
+
+    def set_state(self, model, state: str):
+        if state not in self.states:
+            raise ValueError('State {!r} is not a registered state'.format(
+                state,
+            ))
+        model.state = state
+
+    def trigger(self, model, event: str):
+        dest = self.events[event].get(model.state)
+        if dest is None:
+            raise MachineError(
+                "Can't trigger event {} from state {}".format(
+                    event,
+                    model.state,
+                )
+            )
+        model.state = dest
+        return True
+
+    def bind(self, cls):
+        for event in self.events:
+            setattr(cls, event, self._make_trigger(event))
+        cls.machine = self
+        return cls
+
+    def _make_trigger(self, event):
+        def trigger(model, *args, **kwargs):
+            return self.trigger(model, event)
+
+        trigger.__name__ = event
+        return trigger
+
+
+def state_machine(initial: str):
+    """Compile ``cls.states`` and ``cls.transitions`` once for the class."""
+    def decorator(cls):
+        machine = StateMachine(cls.states, cls.transitions, initial=initial)
+        return machine.bind(cls)
+    return decorator
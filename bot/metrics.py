@@ -0,0 +1,252 @@
+import time
+import bisect
+import logging
+import threading
+import contextlib
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+registry = []
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def format_labels(labels: dict):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, escape(value))
+        for name, value in labels.items()
+    ))
+
+
+def format_value(value: float):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = collections.defaultdict(float)
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+
+class Counter(Metric):
+    """Monotonic counter with optional labels."""
+
+    kind = 'counter'
+
+    def inc(self, amount: float=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] += amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [
+            (dict(zip(self.labelnames, key)), value)
+            for key, value in items
+        ]
+
+    def expose(self):
+        return [
+            '{}{} {}'.format(self.name, format_labels(labels),
+                             format_value(value))
+            for labels, value in self.samples()
+        ]
+
+
+class Histogram(Metric):
+    """Distribution of observations over ``buckets``, with optional labels."""
+
+    kind = 'histogram'
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # Per label set: a count per bucket and the +Inf one, then the sum.
+        self._values = collections.defaultdict(
+            lambda: [0] * (len(self.buckets) + 1) + [0.0],
+        )
+
+    def observe(self, amount: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, amount)
+        with self._lock:
+            values = self._values[key]
+            values[index] += 1
+            values[-1] += amount
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def value(self, **labels):
+        """Number of observations."""
+        values = self._values.get(self._key(labels))
+        return sum(values[:-1]) if values else 0
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(values)) for key, values in
+                     self._values.items()]
+        return [
+            (dict(zip(self.labelnames, key)), values)
+            for key, values in items
+        ]
+
+    def expose(self):
+        lines = []
+        for labels, values in self.samples():
+            count = 0
+            for bound, observed in zip(self.buckets + (float('inf'),),
+                                       values):
+                count += observed
+                lines.append('{}_bucket{} {}'.format(
+                    self.name,
+                    format_labels(dict(labels, le=format_value(bound))),
+                    count,
+                ))
+            lines.append('{}_sum{} {}'.format(
+                self.name, format_labels(labels), format_value(values[-1]),
+            ))
+            lines.append('{}_count{} {}'.format(
+                self.name, format_labels(labels), count,
+            ))
+        return lines
+
+
+def exposition():
+    """All metrics in the Prometheus text format."""
+    lines = []
+    for metric in registry:
+        lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def start_server(port: int):
+    """Serve /metrics from a daemon thread, nothing when port is 0."""
+    if not port:
+        return
+
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logger.info('Serving metrics on port %s', port)
+    return server
+
+
+skyscanner_requests = Counter(
+    'skyscanner_requests_total',
+    'Skyscanner API requests by endpoint and outcome',
+    ['endpoint', 'outcome'],
+)
+skyscanner_request_seconds = Counter(
+    'skyscanner_request_seconds_total',
+    'Time spent in Skyscanner API requests, retries included',
+    ['endpoint'],
+)
+skyscanner_retries = Counter(
+    'skyscanner_retries_total',
+    'Retried Skyscanner API requests',
+    ['endpoint', 'reason'],
+)
+skyscanner_breaker_trips = Counter(
+    'skyscanner_breaker_trips_total',
+    'Times the Skyscanner circuit breaker opened',
+    ['endpoint'],
+)
+quote_cache_requests = Counter(
+    'quote_cache_requests_total',
+    'browsequotes cache lookups by result (hit, miss, coalesced)',
+    ['result'],
+)
+inline_cache_requests = Counter(
+    'inline_cache_requests_total',
+    'Inline query result lookups by result (hit, miss)',
+    ['result'],
+)
+skyscanner_request_duration = Histogram(
+    'skyscanner_request_duration_seconds',
+    'Skyscanner API request latency, retries included',
+    ['endpoint'],
+)
+handler_seconds = Histogram(
+    'bot_handler_seconds',
+    'Update handling time by handler, route covers the state handlers',
+    ['handler'],
+)
+handler_errors = Counter(
+    'bot_handler_errors_total',
+    'Handlers failed with an exception',
+    ['handler'],
+)
+redis_session_seconds = Histogram(
+    'redis_session_seconds',
+    'Session reads and writes to redis',
+    ['operation'],
+)
+session_cache_requests = Counter(
+    'session_cache_requests_total',
+    'In-memory session lookups by result (hit, miss)',
+    ['result'],
+)
+db_query_seconds = Histogram(
+    'db_query_seconds',
+    'Database queries by statement',
+    ['statement'],
+)
@@ -0,0 +1,69 @@
+"""Schema migrations.
+
+Creates missing tables and adds the unique indexes of ``BotUser.uid`` and
+``Channel(user, uid)`` to databases created before them. Duplicate rows
+are merged first, keeping the oldest one.
+
+    python -m bot.migrations
+"""
+import logging
+
+from playhouse.migrate import PostgresqlMigrator, migrate
+
+from bot.utils import db, init_db, BotUser, Channel
+
+
+logger = logging.getLogger(__name__)
+
+MERGE_DUPLICATE_USERS = '''
+UPDATE channel SET user_id = keep.id
+FROM botuser AS dup, (
+    SELECT uid, MIN(id) AS id FROM botuser GROUP BY uid
+) AS keep
+WHERE channel.user_id = dup.id AND dup.uid = keep.uid AND dup.id != keep.id
+'''
+DELETE_DUPLICATE_USERS = '''
+DELETE FROM botuser WHERE id NOT IN (
+    SELECT MIN(id) FROM botuser GROUP BY uid
+)
+'''
+DELETE_DUPLICATE_CHANNELS = '''
+DELETE FROM channel WHERE id NOT IN (
+    SELECT MIN(id) FROM channel GROUP BY user_id, uid
+)
+'''
+
+
+def get_index_names(table: str):
+    return {index.name for index in db.get_indexes(table)}
+
+
+def add_unique_indexes():
+    migrator = PostgresqlMigrator(db.obj)
+    operations = []
+    if 'botuser_uid' not in get_index_names('botuser'):
+        db.execute_sql(MERGE_DUPLICATE_USERS)
+        db.execute_sql(DELETE_DUPLICATE_USERS)
+        operations.append(migrator.add_index('botuser', ('uid',), True))
+    if 'channel_user_id_uid' not in get_index_names('channel'):
+        db.execute_sql(DELETE_DUPLICATE_CHANNELS)
+        operations.append(
+            migrator.add_index('channel', ('user_id', 'uid'), True),
+        )
+    if operations:
+        migrate(*operations)
+    return len(operations)
+
+
+def run():
+    init_db()
+    with db.connection_context():
+        with db.atomic():
+            db.create_tables([BotUser, Channel], safe=True)
+            added = add_unique_indexes()
+    logger.info('Added %s indexes', added)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    run()
@@ -0,0 +1,94 @@
+"""Sampling profiler of slow updates.
+
+While an update is handled, a background thread samples the stack of the
+handling thread every ``PROFILE_INTERVAL`` seconds. When the update took
+longer than ``PROFILE_SLOW_UPDATES`` seconds, the most frequent stacks are
+logged, so the slow call shows up without profiling every update.
+"""
+import sys
+import time
+import logging
+import threading
+import traceback
+import contextlib
+import collections
+
+from .constants import PROFILE_SLOW_UPDATES, PROFILE_INTERVAL
+
+
+logger = logging.getLogger(__name__)
+
+
+class SlowUpdateProfiler:
+    def __init__(self,
+                 threshold: float=PROFILE_SLOW_UPDATES,
+                 interval: float=PROFILE_INTERVAL,
+                 top: int=5):
+        self.threshold = threshold
+        self.interval = interval
+        self.top = top
+        # Thread id of each update being handled -> its stack samples.
+        self.active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    def ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, samples in self.active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        samples[self.format_stack(frame)] += 1
+
+    @staticmethod
+    def format_stack(frame):
+        return ';'.join(
+            '{}:{}:{}'.format(f.filename.rsplit('/', 1)[-1], f.name, f.lineno)
+            for f in traceback.extract_stack(frame)
+        )
+
+    @contextlib.contextmanager
+    def watch(self, name: str):
+        if not self.enabled:
+            yield
+            return
+
+        self.ensure_started()
+        ident = threading.get_ident()
+        samples = collections.Counter()
+        with self._lock:
+            self.active[ident] = samples
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                del self.active[ident]
+            if elapsed >= self.threshold:
+                self.report(name, elapsed, samples)
+
+    def report(self, name: str, elapsed: float, samples):
+        total = sum(samples.values())
+        lines = [
+            '{:5.1f}% {}'.format(100 * count / total, stack)
+            for stack, count in samples.most_common(self.top)
+        ]
+        logger.warning('Slow update in %s: %.3fs, %d samples\n%s',
+                       name, elapsed, total, '\n'.join(lines))
+
+
+profiler = SlowUpdateProfiler()
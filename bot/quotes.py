@@ -0,0 +1,86 @@
+import json
+import threading
+from concurrent.futures import Future
+
+from . import metrics
+from .constants import QUOTES_CACHE_TTL
+
+
+class Singleflight:
+    """Runs one call per key at a time, concurrent callers share its result."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """Return ``(result, shared)``, shared is True for waiting callers."""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            return future.result(), True
+
+        try:
+            future.set_result(func())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return future.result(), False
+
+
+class QuoteCache:
+    """``browsequotes`` responses in redis for ``ttl`` seconds.
+
+    Responses are keyed by the request url, which holds the market
+    country, currency, locale, route and dates. Only responses with
+    quotes are cached, 4xx bodies such as ``ValidationErrors`` come back
+    as data and are not.
+    """
+
+    def __init__(self, redis, ttl: int=QUOTES_CACHE_TTL):
+        self.redis = redis
+        self.ttl = ttl
+        self.flights = Singleflight()
+
+    @staticmethod
+    def make_key(url: str):
+        return 'quotes_{}'.format(url.split('://', 1)[-1])
+
+    @staticmethod
+    def record(result: str):
+        metrics.quote_cache_requests.inc(result=result)
+
+    @staticmethod
+    def cacheable(data):
+        return isinstance(data, dict) and 'Quotes' in data
+
+    def get(self, key: str):
+        raw = self.redis.get(key)
+        if raw is not None:
+            return json.loads(raw.decode())
+
+    def set(self, key: str, data: dict):
+        self.redis.set(key, json.dumps(data), ex=self.ttl)
+
+    def get_or_fetch(self, url: str, fetch):
+        key = self.make_key(url)
+        data = self.get(key)
+        if data is not None:
+            self.record('hit')
+            return data
+
+        data, shared = self.flights.do(key, lambda: self._fetch(key, fetch))
+        self.record('coalesced' if shared else 'miss')
+        return data
+
+    def _fetch(self, key, fetch):
+        data = fetch()
+        if self.cacheable(data):
+            self.set(key, data)
+        return data
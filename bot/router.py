@@ -0,0 +1,19 @@
+class StateRouter:
+    """Handlers registered for the user states.
+
+    A handler takes the message and the session of its user, the
+    conversation loads the session once per update.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+
+    def state(self, *states):
+        def decorator(func):
+            for state in states:
+                self.handlers[state.value] = func
+            return func
+        return decorator
+
+    def resolve(self, state: str):
+        return self.handlers.get(state)
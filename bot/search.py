@@ -0,0 +1,136 @@
+import re
+import array
+import bisect
+import heapq
+import collections
+
+from .constants import SEARCH_RESULTS_LIMIT, SEARCH_SCAN_LIMIT, \
+    SEARCH_FUZZY_THRESHOLD
+
+
+NON_ALNUM = re.compile(r'[\W_]+')
+
+# Match kinds, lower is better.
+EXACT = 0
+PREFIX = 1
+WORD_PREFIX = 2
+FUZZY = 3
+
+
+def normalize(text: str):
+    text = text.casefold().replace('ё', 'е')
+    return NON_ALNUM.sub(' ', text).strip()
+
+
+def trigrams(text: str):
+    grams = set()
+    for word in text.split():
+        word = ' {} '.format(word)
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+class PlaceIndex:
+    """Ranked search over ``City``/``Country`` tuples.
+
+    Prefix lookups bisect a sorted list of normalized names and word
+    suffixes ("нижний новгород" is reachable by "новг"). Queries without
+    enough prefix hits fall back to trigram similarity, which tolerates
+    typos.
+    """
+
+    def __init__(self, places, scan_limit: int=SEARCH_SCAN_LIMIT):
+        self.places = tuple(places)
+        self.scan_limit = scan_limit
+        self.names = [normalize(p.name) for p in self.places]
+
+        entries = []
+        postings = collections.defaultdict(list)
+        self.gram_counts = array.array('H')
+        for i, name in enumerate(self.names):
+            entries.append((name, i))
+            for match in re.finditer(' ', name):
+                entries.append((name[match.end():], i))
+
+            grams = trigrams(name)
+            self.gram_counts.append(min(len(grams), 0xFFFF))
+            for gram in grams:
+                postings[gram].append(i)
+
+        entries.sort()
+        self.keys = [key for key, _ in entries]
+        self.key_places = array.array('I', (i for _, i in entries))
+        self.postings = {
+            gram: array.array('I', ids) for gram, ids in postings.items()
+        }
+
+    def __len__(self):
+        return len(self.places)
+
+    def search(self, query: str, limit: int=SEARCH_RESULTS_LIMIT):
+        query = normalize(query)
+        if not query:
+            return []
+
+        best = {}
+        self._match_prefix(query, best)
+        if len(best) < limit:
+            self._match_fuzzy(query, best)
+
+        ranked = heapq.nsmallest(
+            limit,
+            best.items(),
+            key=lambda item: (item[1], len(self.names[item[0]]), item[0]),
+        )
+        return [self.place(i) for i, _ in ranked]
+
+    def place(self, i: int):
+        return self.places[i]
+
+    def candidates(self, gram: str):
+        """Ids of the places having ``gram``, in ascending order."""
+        return self.postings.get(gram, ())
+
+    def first(self, query: str):
+        found = self.search(query, limit=1)
+        return found[0] if found else None
+
+    def _match_prefix(self, query, best):
+        start = bisect.bisect_left(self.keys, query)
+        stop = min(start + self.scan_limit, len(self.keys))
+        for pos in range(start, stop):
+            key = self.keys[pos]
+            if not key.startswith(query):
+                break
+
+            i = self.key_places[pos]
+            name = self.names[i]
+            if name == query:
+                kind = EXACT
+            elif len(key) == len(name):
+                kind = PREFIX
+            else:
+                kind = WORD_PREFIX
+
+            if kind < best.get(i, FUZZY + 1):
+                best[i] = kind
+
+    def _match_fuzzy(self, query, best):
+        grams = trigrams(query)
+        if not grams:
+            return
+
+        hits = collections.Counter()
+        for gram in grams:
+            hits.update(self.candidates(gram))
+
+        for i, common in hits.items():
+            if i in best:
+                continue
+            # Jaccard similarity of the trigram sets.
+            total = len(grams) + self.gram_counts[i] - common
+            score = common / total
+            if score >= SEARCH_FUZZY_THRESHOLD:
+                # Keep the ranking key numeric: fuzzy hits sort after
+                # prefix hits and by descending similarity.
+                best[i] = FUZZY + (1 - score)
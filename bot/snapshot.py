@@ -0,0 +1,389 @@
+"""Binary snapshot of the geo catalog and its search indexes.
+
+Built offline from the Skyscanner geo tree and mapped read-only. Lookups
+are served from the mapped arrays and only decode the strings they touch,
+so every process on a host shares one page-cached copy of the catalog,
+and starts without a geo request or building an index. Layout, in native
+byte order, sections aligned to 8 bytes:
+
+    header      magic, version, byte order, fetched_at, sections count
+    uint32      length of every section
+    uint32      string offsets into the blob
+    uint32      country name and id strings
+    uint32      first city of each country, one more than the countries
+    uint32      city name and id strings, cities grouped by country
+    uint32      ``PlaceIndex`` of the countries and of the cities:
+                normalized names, sorted keys and their places, trigram
+                counts, sorted trigrams with the start of their postings,
+                postings
+    uint32      keys of the city index sorted by country, then key, with
+                the first key of each country
+    bytes       UTF-8 blob of the strings, each one stored once
+
+    python -m bot.snapshot build geo.snapshot [--input geo.json]
+    python -m bot.snapshot info geo.snapshot
+"""
+import os
+import sys
+import mmap
+import time
+import array
+import bisect
+import struct
+import argparse
+import tempfile
+
+from .constants import Country, City, SEARCH_SCAN_LIMIT
+from .search import PlaceIndex
+
+
+MAGIC = b'GEOS'
+VERSION = 2
+HEADER = struct.Struct('=4sHBxdI')
+BYTE_ORDERS = {'little': 0, 'big': 1}
+ALIGNMENT = 8
+INDEX_SECTIONS = ('normalized', 'keys', 'key_places', 'gram_counts',
+                  'grams', 'posting_starts', 'postings')
+SECTIONS = (
+    'string_offsets',
+    'country_names',
+    'country_ids',
+    'city_starts',
+    'city_names',
+    'city_ids',
+) + tuple(
+    '{}_{}'.format(kind, name)
+    for kind in ('country', 'city')
+    for name in INDEX_SECTIONS
+) + (
+    'city_country_keys',
+    'city_country_key_places',
+    'city_country_key_starts',
+)
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def align(offset: int):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def iter_countries(f):
+    """Countries of a geo JSON file, parsed as a stream."""
+    import ijson
+
+    return ijson.items(f, 'Continents.item.Countries.item')
+
+
+class SnapshotWriter:
+    def __init__(self):
+        self.strings = {}
+        self.blob = bytearray()
+        self.sections = {name: array.array('I') for name in SECTIONS}
+        self.sections['string_offsets'].append(0)
+        self.sections['city_starts'].append(0)
+        self.countries = []
+        self.cities = []
+
+    def intern(self, value: str):
+        index = self.strings.get(value)
+        if index is None:
+            index = self.strings[value] = len(self.strings)
+            self.blob += value.encode()
+            self.sections['string_offsets'].append(len(self.blob))
+        return index
+
+    def add_country(self, country: dict):
+        self.countries.append(Country(country['Name'], country['Id']))
+        self.sections['country_names'].append(self.intern(country['Name']))
+        self.sections['country_ids'].append(self.intern(country['Id']))
+        for city in country['Cities']:
+            self.cities.append(City(city['Name'], city['Id'], country['Id']))
+            self.sections['city_names'].append(self.intern(city['Name']))
+            self.sections['city_ids'].append(self.intern(city['Id']))
+        self.sections['city_starts'].append(len(self.cities))
+
+    def add_index(self, kind: str, index: PlaceIndex):
+        section = {
+            name: self.sections['{}_{}'.format(kind, name)]
+            for name in INDEX_SECTIONS
+        }
+        section['normalized'].extend(self.intern(n) for n in index.names)
+        section['keys'].extend(self.intern(key) for key in index.keys)
+        section['key_places'].extend(index.key_places)
+        section['gram_counts'].extend(list(index.gram_counts))
+        section['posting_starts'].append(0)
+        for gram in sorted(index.postings):
+            section['grams'].append(self.intern(gram))
+            section['postings'].extend(index.postings[gram])
+            section['posting_starts'].append(len(section['postings']))
+
+    def add_indexes(self):
+        self.add_index('country', PlaceIndex(self.countries))
+        city_index = PlaceIndex(self.cities)
+        self.add_index('city', city_index)
+
+        # The keys of a country's cities are a range, in the same order as
+        # in an index of these cities alone.
+        starts = self.sections['city_starts']
+        country_of = [
+            bisect.bisect_right(starts, i) - 1
+            for i in city_index.key_places
+        ]
+        order = sorted(range(len(country_of)), key=country_of.__getitem__)
+        keys = self.sections['city_keys']
+        self.sections['city_country_keys'].extend(keys[pos] for pos in order)
+        self.sections['city_country_key_places'].extend(
+            city_index.key_places[pos] for pos in order
+        )
+        sorted_countries = [country_of[pos] for pos in order]
+        self.sections['city_country_key_starts'].extend(
+            bisect.bisect_left(sorted_countries, i)
+            for i in range(len(self.countries) + 1)
+        )
+
+    def write(self, f, fetched_at: float):
+        sections = [self.sections[name] for name in SECTIONS]
+        lengths = array.array('I', [len(s) for s in sections])
+        lengths.append(len(self.blob))
+        f.write(HEADER.pack(
+            MAGIC,
+            VERSION,
+            BYTE_ORDERS[sys.byteorder],
+            fetched_at,
+            len(lengths),
+        ))
+        for section in [lengths] + sections + [self.blob]:
+            f.write(b'\0' * (align(f.tell()) - f.tell()))
+            f.write(section)
+
+
+def build(countries, path: str, fetched_at: float=None):
+    """Write the snapshot of ``countries``, geo tree country dicts.
+
+    The file is replaced atomically, processes that mapped the previous
+    one keep reading it.
+    """
+    writer = SnapshotWriter()
+    for country in countries:
+        writer.add_country(country)
+    writer.add_indexes()
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            writer.write(f, time.time() if fetched_at is None else fetched_at)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return writer
+
+
+class StringArray:
+    """Strings of the ids in ``ids``, decoded on access."""
+
+    def __init__(self, snapshot, ids):
+        self.snapshot = snapshot
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i: int):
+        return self.snapshot.string(self.ids[i])
+
+
+class CityArray:
+    """Cities of a snapshot, made on access."""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __len__(self):
+        return len(self.snapshot.city_ids)
+
+    def __getitem__(self, i: int):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.snapshot.city(i)
+
+
+class SnapshotIndex(PlaceIndex):
+    """``PlaceIndex`` over the arrays of a snapshot.
+
+    Restricted to the places ``lo`` to ``hi`` when the keys are those of
+    a country, the postings hold all of them.
+    """
+
+    def __init__(self,
+                 snapshot,
+                 kind: str,
+                 place,
+                 keys=None,
+                 key_places=None,
+                 lo: int=0,
+                 hi: int=None):
+        def section(name):
+            return getattr(snapshot, '{}_{}'.format(kind, name))
+
+        self.place = place
+        self.names = StringArray(snapshot, section('normalized'))
+        self.keys = StringArray(
+            snapshot, section('keys') if keys is None else keys,
+        )
+        self.key_places = section('key_places') \
+            if key_places is None else key_places
+        self.gram_counts = section('gram_counts')
+        self.grams = StringArray(snapshot, section('grams'))
+        self.posting_starts = section('posting_starts')
+        self.postings = section('postings')
+        self.lo = lo
+        self.hi = len(self.names) if hi is None else hi
+        self.scan_limit = SEARCH_SCAN_LIMIT
+
+    def __len__(self):
+        return self.hi - self.lo
+
+    def candidates(self, gram: str):
+        pos = bisect.bisect_left(self.grams, gram)
+        if pos == len(self.grams) or self.grams[pos] != gram:
+            return ()
+        ids = self.postings[self.posting_starts[pos]:
+                            self.posting_starts[pos + 1]]
+        return ids[bisect.bisect_left(ids, self.lo):
+                   bisect.bisect_left(ids, self.hi)]
+
+
+class GeoSnapshot:
+    """Read-only view of a snapshot file, arrays are not copied."""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise SnapshotError('{} is empty'.format(path))
+        view = memoryview(self._mmap)
+        if len(view) < HEADER.size:
+            raise SnapshotError('{} is truncated'.format(path))
+
+        magic, version, byte_order, self.fetched_at, n_sections = \
+            HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise SnapshotError('{} is not a geo snapshot'.format(path))
+        if version != VERSION:
+            raise SnapshotError('{} has version {}, expected {}'.format(
+                path, version, VERSION,
+            ))
+        if byte_order != BYTE_ORDERS[sys.byteorder]:
+            raise SnapshotError('{} has another byte order'.format(path))
+        if n_sections != len(SECTIONS) + 1:
+            raise SnapshotError('{} has {} sections, expected {}'.format(
+                path, n_sections, len(SECTIONS) + 1,
+            ))
+
+        self._view = view
+        self._offset = HEADER.size
+        lengths = self._take(n_sections)
+        for name, length in zip(SECTIONS, lengths):
+            setattr(self, name, self._take(length))
+        self.blob = self._take_bytes(lengths[-1])
+
+    def _take_bytes(self, size: int):
+        start = align(self._offset)
+        if start + size > len(self._view):
+            raise SnapshotError('Snapshot is truncated')
+        self._offset = start + size
+        return self._view[start:self._offset]
+
+    def _take(self, count: int):
+        return self._take_bytes(count * 4).cast('I')
+
+    def __len__(self):
+        return len(self.string_offsets) - 1
+
+    def string(self, index: int):
+        return str(
+            self.blob[self.string_offsets[index]:
+                      self.string_offsets[index + 1]],
+            'utf-8',
+        )
+
+    def country(self, i: int):
+        return Country(self.string(self.country_names[i]),
+                       self.string(self.country_ids[i]))
+
+    def city(self, i: int):
+        country = bisect.bisect_right(self.city_starts, i) - 1
+        return City(self.string(self.city_names[i]),
+                    self.string(self.city_ids[i]),
+                    self.string(self.country_ids[country]))
+
+    def countries(self):
+        return tuple(self.country(i) for i in range(len(self.country_ids)))
+
+    def cities(self):
+        return CityArray(self)
+
+    def country_index(self):
+        return SnapshotIndex(self, 'country', self.country)
+
+    def city_index(self):
+        return SnapshotIndex(self, 'city', self.city)
+
+    def country_city_index(self, country: int):
+        """Index of the cities of the ``country``-th country."""
+        start = self.city_country_key_starts[country]
+        stop = self.city_country_key_starts[country + 1]
+        return SnapshotIndex(
+            self,
+            'city',
+            self.city,
+            keys=self.city_country_keys[start:stop],
+            key_places=self.city_country_key_places[start:stop],
+            lo=self.city_starts[country],
+            hi=self.city_starts[country + 1],
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    build_parser = subparsers.add_parser('build')
+    build_parser.add_argument('path')
+    build_parser.add_argument('--input',
+                              help='geo JSON file, downloaded when omitted')
+    info_parser = subparsers.add_parser('info')
+    info_parser.add_argument('path')
+    args = parser.parse_args()
+
+    if args.command == 'info':
+        snapshot = GeoSnapshot(args.path)
+        print('fetched at {}, {} countries, {} cities, {} strings'.format(
+            time.ctime(snapshot.fetched_at),
+            len(snapshot.country_ids),
+            len(snapshot.city_ids),
+            len(snapshot),
+        ))
+        return
+
+    if args.input:
+        with open(args.input, 'rb') as f:
+            writer = build(iter_countries(f), args.path,
+                           os.path.getmtime(args.input))
+    else:
+        from .utils import api
+        with api.open_geo() as response:
+            writer = build(iter_countries(response.raw), args.path)
+    print('{} countries, {} cities, {} strings'.format(
+        len(writer.countries), len(writer.cities), len(writer.strings),
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+"""Redis Streams execution mode of the bot.
+
+The receiver accepts Telegram webhooks and appends each update to one of
+``STREAM_SHARDS`` streams, chosen by user id. Workers read the streams
+through a consumer group; every shard is owned by exactly one worker
+which processes its entries in order, so a user's conversation stays
+ordered while users are spread over processes and nodes.
+
+Entries are acknowledged once handled. A failed entry is retried in
+place with backoff, so later entries of its shard wait for it; after
+``STREAM_MAX_DELIVERIES`` attempts it is moved to the dead letter stream.
+When redis fails, the shard backs off and then reads its pending entries
+again before new ones, entries are never handled out of order. Entries
+left pending by a worker that no longer owns the shard are claimed once
+idle for ``STREAM_RETRY_IDLE`` ms, the owner looks for them that often
+and handles them before reading new entries.
+
+    python -m bot.streams receiver
+    python -m bot.streams worker
+"""
+import os
+import time
+import logging
+import argparse
+import threading
+
+import telebot
+from redis import StrictRedis
+from redis.exceptions import ResponseError
+from telebot import types
+
+from bot.constants import TOKEN, REDIS_URL, STREAM_KEY, STREAM_GROUP, \
+    STREAM_SHARDS, STREAM_MAXLEN, STREAM_BLOCK, STREAM_BATCH, \
+    STREAM_RETRY_IDLE, STREAM_MAX_DELIVERIES, STREAM_RETRY_BACKOFF, \
+    STREAM_RETRY_BACKOFF_MAX
+from bot.webhook import get_shard_key, serve
+
+
+logger = logging.getLogger(__name__)
+
+
+def stream_name(shard: int):
+    return '{}_{}'.format(STREAM_KEY, shard)
+
+
+def dead_letter_name():
+    return '{}_dead'.format(STREAM_KEY)
+
+
+class StreamPublisher:
+    """Webhook pipeline writing updates to the sharded streams."""
+
+    def __init__(self, redis, shards: int=STREAM_SHARDS):
+        self.redis = redis
+        self.shards = shards
+
+    def shard(self, update):
+        return hash(get_shard_key(update)) % self.shards
+
+    def submit(self, update, raw: str=None):
+        self.redis.xadd(
+            stream_name(self.shard(update)),
+            {'update': raw},
+            maxlen=STREAM_MAXLEN,
+            approximate=True,
+        )
+        return True
+
+
+class StreamWorker:
+    """Consumes the shards owned by worker ``index`` of ``count``."""
+
+    def __init__(self,
+                 redis,
+                 process,
+                 index: int,
+                 count: int,
+                 shards: int=STREAM_SHARDS):
+        self.redis = redis
+        self.process = process
+        self.consumer = 'worker_{}'.format(index)
+        self.streams = [
+            stream_name(shard)
+            for shard in range(shards)
+            if shard % count == index
+        ]
+
+    def ensure_group(self, stream: str):
+        try:
+            self.redis.xgroup_create(stream, STREAM_GROUP, id='0',
+                                     mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def run(self):
+        threads = []
+        for stream in self.streams:
+            self.ensure_group(stream)
+            thread = threading.Thread(target=self.consume, args=(stream,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+    @staticmethod
+    def delay(attempt: int):
+        return min(STREAM_RETRY_BACKOFF * 2 ** attempt,
+                   STREAM_RETRY_BACKOFF_MAX)
+
+    def consume(self, stream: str):
+        # Pending entries come first: those delivered to this consumer
+        # before a restart or a failure, and the claimed ones.
+        last_id = '0'
+        failures = 0
+        next_claim = 0
+        while True:
+            try:
+                # Entries of the previous owner of the shard are usually
+                # not idle yet when it changes hands, so the claim runs
+                # again every STREAM_RETRY_IDLE.
+                if last_id == '0' or time.monotonic() >= next_claim:
+                    if self.claim_abandoned(stream):
+                        last_id = '0'
+                    next_claim = time.monotonic() + STREAM_RETRY_IDLE / 1000
+                entries = self.read(stream, last_id)
+                if last_id != '>':
+                    if not entries:
+                        last_id = '>'
+                        continue
+                    last_id = entries[-1][0]
+                for entry_id, fields in entries:
+                    self.handle(stream, entry_id, fields)
+                failures = 0
+            except Exception:
+                logger.exception('Failed to consume %s', stream)
+                time.sleep(self.delay(failures))
+                failures += 1
+                last_id = '0'
+
+    def read(self, stream: str, last_id: str):
+        response = self.redis.xreadgroup(
+            STREAM_GROUP,
+            self.consumer,
+            {stream: last_id},
+            count=STREAM_BATCH,
+            block=STREAM_BLOCK if last_id == '>' else None,
+        )
+        return response[0][1] if response else []
+
+    def handle(self, stream: str, entry_id, fields: dict):
+        if fields is None:
+            # Trimmed by MAXLEN while pending, nothing left to process.
+            self.redis.xack(stream, STREAM_GROUP, entry_id)
+            return
+
+        update = types.Update.de_json(fields[b'update'].decode())
+        for attempt in range(STREAM_MAX_DELIVERIES):
+            try:
+                self.process(update)
+            except Exception:
+                logger.exception('Failed to process %s %s', stream, entry_id)
+                if attempt + 1 < STREAM_MAX_DELIVERIES:
+                    time.sleep(self.delay(attempt))
+            else:
+                self.redis.xack(stream, STREAM_GROUP, entry_id)
+                return
+        self.bury(stream, entry_id)
+
+    def claim_abandoned(self, stream: str):
+        """Take over the entries other consumers left pending.
+
+        Return how many were claimed.
+        """
+        pending = self.redis.xpending_range(
+            stream,
+            STREAM_GROUP,
+            min='-',
+            max='+',
+            count=STREAM_BATCH,
+            idle=STREAM_RETRY_IDLE,
+        )
+        claimed = 0
+        for entry in pending:
+            if entry['consumer'].decode() == self.consumer:
+                continue
+            entry_id = entry['message_id']
+            if entry['times_delivered'] >= STREAM_MAX_DELIVERIES:
+                self.bury(stream, entry_id)
+                continue
+            # Read from the pending entries of this consumer, in order.
+            self.redis.xclaim(
+                stream,
+                STREAM_GROUP,
+                self.consumer,
+                STREAM_RETRY_IDLE,
+                [entry_id],
+                justid=True,
+            )
+            claimed += 1
+        return claimed
+
+    def bury(self, stream: str, entry_id):
+        entries = self.redis.xrange(stream, entry_id, entry_id)
+        if entries:
+            _, fields = entries[0]
+            fields = dict(fields, stream=stream, id=entry_id)
+            self.redis.xadd(dead_letter_name(), fields,
+                            maxlen=STREAM_MAXLEN, approximate=True)
+        self.redis.xack(stream, STREAM_GROUP, entry_id)
+        logger.error('Gave up on %s %s', stream, entry_id)
+
+
+def get_worker_index():
+    """STREAM_WORKER_INDEX, or the number of a Heroku dyno (worker.N)."""
+    if 'STREAM_WORKER_INDEX' in os.environ:
+        return int(os.environ['STREAM_WORKER_INDEX'])
+
+    dyno = os.environ.get('DYNO', '')
+    if '.' in dyno:
+        return int(dyno.rsplit('.', 1)[1]) - 1
+    return 0
+
+
+def run_receiver():
+    from bot.app import App
+
+    redis = StrictRedis.from_url(REDIS_URL)
+    app = App({'redis': redis.ping}).start()
+    serve(telebot.TeleBot(TOKEN), StreamPublisher(redis), app.ready)
+
+
+def run_worker(index: int, count: int):
+    from bot.app import create_app
+    from bot.main import bot, watcher
+    from bot.utils import redis
+    from bot.writes import writes
+
+    bot.threaded = False
+    create_app(bot=bot, services=[writes, watcher]).start()
+    StreamWorker(
+        redis,
+        lambda update: bot.process_new_updates([update]),
+        index,
+        count,
+    ).run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('role', choices=['receiver', 'worker'])
+    parser.add_argument('--index', type=int, default=get_worker_index())
+    parser.add_argument('--count', type=int,
+                        default=int(os.environ.get('STREAM_WORKERS', 1)))
+    args = parser.parse_args()
+
+    if args.role == 'receiver':
+        run_receiver()
+    else:
+        run_worker(args.index, args.count)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
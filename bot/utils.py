@@ -1,39 +1,121 @@
 import datetime
+import threading
+import contextlib
+import collections
+from urllib import parse
+from concurrent.futures import ThreadPoolExecutor, wait
 
-import requests
-from transitions import Machine
 from redis import StrictRedis
 import peewee
+from playhouse.pool import PooledDatabase, PooledPostgresqlDatabase
 
-from .constants import REDIS_URL, UserStates, City, Country, Ticket, DB_NAME, \
-    DB_USERNAME, DB_PASSWORD, DB_HOST, DB_PORT, SKYSCANNER_TOKEN, \
+from .constants import REDIS_URL, UserStates, Ticket, DATABASE_URL, \
+    DB_POOL_SIZE, DB_POOL_STALE_TIMEOUT, SKYSCANNER_TOKEN, \
     SKYSCANNER_API_URL, SKYSCANNER_API_VERSION, SKYSCANNER_CURRENCY, \
-    SKYSCANNER_LOCALE, SKYSCANNER_DATE_FORMAT
+    SKYSCANNER_LOCALE, SKYSCANNER_DATE_FORMAT, SKYSCANNER_MONTH_FORMAT, \
+    SESSION_TTL, SESSION_CACHE_SIZE, SKYSCANNER_POOL_SIZE, \
+    SKYSCANNER_RETRY_BACKOFF, SKYSCANNER_RETRY_BACKOFF_MAX, \
+    SKYSCANNER_BREAKER_THRESHOLD, SKYSCANNER_BREAKER_TIMEOUT, \
+    SKYSCANNER_SEARCH_CONCURRENCY, ANYWHERE_DEADLINE
+
+from . import metrics
+from .errors import BaseSkyscannerApiException
+from .geo import GeoCatalog
+from .client import HttpClient
+from .instrument import instrument_database
+from .quotes import QuoteCache
+from .machine import state_machine
+from .flexible import PriceCalendar, merge_quotes, stay_months
+from .anywhere import rank_destinations
+
+
+class Lazy:
+    """Stands in for the object ``factory`` makes on first use.
+
+    Its own attributes are private, the public ones are the object's.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._obj = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def _resolve(self):
+        if self._obj is None:
+            with self._lock:
+                if self._obj is None:
+                    self._obj = self._factory()
+        return self._obj
+
+
+redis = Lazy(lambda: StrictRedis.from_url(REDIS_URL))
+
+
+def create_db(url: str=DATABASE_URL):
+    if not url:
+        raise RuntimeError('DATABASE_URL is not set')
+
+    url = parse.urlparse(url)
+    params = dict(
+        user=url.username,
+        password=url.password,
+        host=url.hostname,
+        port=url.port,
+    )
+    if DB_POOL_SIZE:
+        return PooledPostgresqlDatabase(
+            url.path[1:],
+            max_connections=DB_POOL_SIZE,
+            stale_timeout=DB_POOL_STALE_TIMEOUT,
+            **params
+        )
+    return peewee.PostgresqlDatabase(url.path[1:], **params)
+
+
+# Bound to a database by ``init_db``, the models are defined before that.
+db = peewee.Proxy()
 
-from .errors import SkyscannerApiNotFound
 
+@contextlib.contextmanager
+def db_connection():
+    """Connection of this thread for the block.
 
-redis = StrictRedis.from_url(REDIS_URL)
-db = peewee.PostgresqlDatabase(
-    DB_NAME,
-    user=DB_USERNAME,
-    password=DB_PASSWORD,
-    host=DB_HOST,
-    port=DB_PORT,
-)
+    A pooled connection goes back to the pool after it, otherwise it stays
+    open for the next block of the thread.
+    """
+    if isinstance(db.obj, PooledDatabase):
+        with db.connection_context():
+            yield
+        return
 
+    if db.is_closed():
+        db.connect()
+    try:
+        yield
+    except (peewee.InterfaceError, peewee.OperationalError):
+        # Possibly broken, the next block opens a new one.
+        db.close()
+        raise
 
-class SaveInstance(type):
-    __instances = {}
 
-    def __call__(cls, *args, **kwargs):
-        print()
-        if cls not in cls.__instances:
-            cls.__instances[cls] = super().__call__(*args, **kwargs)
-        return cls.__instances[cls]
+def init_db(database=None):
+    """Bind the models to ``database``, DATABASE_URL by default.
 
+    Without ``database`` a bound database is kept.
+    """
+    if database is None:
+        if db.obj is not None:
+            return db.obj
+        database = instrument_database(create_db())
+    db.initialize(database)
+    return database
 
-class User(metaclass=SaveInstance):
+
+@state_machine(initial=UserStates.SELECT_COUNTRY_FROM.value)
+class User:
     states = UserStates.as_list()
 
     transitions = [
@@ -62,26 +144,34 @@ class User(metaclass=SaveInstance):
             'source': UserStates.SELECT_DATE_FROM.value,
             'dest': UserStates.SELECT_DATE_TO.value,
         },
+        {
+            'trigger': 'to_select_stay',
+            'source': UserStates.SELECT_DATE_FROM.value,
+            'dest': UserStates.SELECT_STAY.value,
+        },
         {
             'trigger': 'to_search_success',
-            'source': UserStates.SELECT_DATE_TO.value,
+            'source': [UserStates.SELECT_DATE_TO.value,
+                       UserStates.SELECT_STAY.value],
             'dest': UserStates.SEARCH_SUCCESS.value,
         },
         {
             'trigger': 'to_search_fail',
-            'source': UserStates.SELECT_DATE_TO.value,
+            'source': [UserStates.SELECT_DATE_TO.value,
+                       UserStates.SELECT_STAY.value],
             'dest': UserStates.SEARCH_FAIL.value,
         },
     ]
 
-    def __init__(self, user_id):
+    fields = ('state', 'country_from', 'place_from', 'place_to',
+              'date_from', 'date_to', 'ticket')
+
+    def __init__(self, user_id, load: bool=True):
         self.user_id = user_id
-        self.machine = Machine(
-            model=self,
-            states=User.states,
-            initial=UserStates.SELECT_COUNTRY_FROM.value,
-            transitions=User.transitions
-        )
+        self.key = '{}_session'.format(user_id)
+        self.dirty = set()
+        self.lock = threading.RLock()
+        self.state = self.machine.initial
 
         self.country_from = None
         self.place_from = None
@@ -90,88 +180,183 @@ class User(metaclass=SaveInstance):
         self.date_to = None
         self.ticket = None
 
-        self.load()
-
-    def __gen_key(self, postfix: str):
-        return '{}_{}'.format(self.user_id, postfix)
-
-    @staticmethod
-    def __set_to_redis(key, value):
-        if value is not None:
-            redis.set(key, value)
+        if load:
+            self.load()
+
+    def __setattr__(self, name, value):
+        if name in User.fields:
+            self.dirty.add(name)
+        super().__setattr__(name, value)
+
+    @property
+    def ticket(self):
+        # Stored tickets are only parsed by the handlers that use them.
+        if self._ticket is None and self._ticket_raw is not None:
+            self._ticket = Ticket.loads(self._ticket_raw)
+        return self._ticket
+
+    @ticket.setter
+    def ticket(self, ticket):
+        self._ticket = ticket
+        self._ticket_raw = None
+
+    def dump_fields(self, fields):
+        """Split fields into values to store and fields to remove."""
+        values = {}
+        removed = []
+        for field in fields:
+            value = getattr(self, field)
+            if value is None:
+                removed.append(field)
+            elif field == 'ticket':
+                values[field] = value.dumps()
+            elif isinstance(value, datetime.date):
+                values[field] = value.strftime(SKYSCANNER_DATE_FORMAT)
+            else:
+                values[field] = value
+        return values, removed
+
+    def load_fields(self, data: dict):
+        for field, value in data.items():
+            field = field.decode()
+            if field == 'ticket':
+                self._ticket = None
+                self._ticket_raw = value
+                continue
 
-    @staticmethod
-    def __get_from_redis(key):
-        return redis.get(key)
+            value = value.decode()
+            if field == 'state':
+                self.machine.set_state(self, value)
+            elif field in ('date_from', 'date_to'):
+                setattr(self, field, datetime.datetime.strptime(
+                    value,
+                    SKYSCANNER_DATE_FORMAT,
+                ).date())
+            elif field in User.fields:
+                setattr(self, field, value)
+        self.dirty.clear()
+
+    def queue_flush(self, pipe):
+        values, removed = self.dump_fields(self.dirty)
+        if values:
+            pipe.hset(self.key, mapping=values)
+        if removed:
+            pipe.hdel(self.key, *removed)
+        pipe.expire(self.key, SESSION_TTL)
+
+    def queue_load(self, pipe):
+        pipe.hgetall(self.key)
+        # Sliding expiration, only idle sessions go away.
+        pipe.expire(self.key, SESSION_TTL)
 
     def flush(self):
-        d0 = self.date_from.strftime(SKYSCANNER_DATE_FORMAT) if self.date_from else None
-        d1 = self.date_to.strftime(SKYSCANNER_DATE_FORMAT) if self.date_to else None
-        self.__set_to_redis(self.__gen_key('state'), self.state)
-        self.__set_to_redis(self.__gen_key('country_from'), self.country_from)
-        self.__set_to_redis(self.__gen_key('place_from'), self.place_from)
-        self.__set_to_redis(self.__gen_key('place_to'), self.place_to)
-        self.__set_to_redis(self.__gen_key('date_from'), d0)
-        self.__set_to_redis(self.__gen_key('date_to'), d1)
+        if not self.dirty:
+            return
+
+        pipe = redis.pipeline(transaction=False)
+        self.queue_flush(pipe)
+        with metrics.redis_session_seconds.time(operation='flush'):
+            pipe.execute()
+        self.dirty.clear()
 
     def load(self):
-        state = self.__get_from_redis(self.__gen_key('state'))
-        if state is not None:
-            self.machine.set_state(state.decode())
-
-        country_from = self.__get_from_redis(self.__gen_key('country_from'))
-        if country_from is not None:
-            self.country_from = country_from.decode()
-
-        place_from = self.__get_from_redis(self.__gen_key('place_from'))
-        if place_from is not None:
-            self.place_from = place_from.decode()
-
-        place_to = self.__get_from_redis(self.__gen_key('place_to'))
-        if place_to is not None:
-            self.place_to = place_to.decode()
-
-        date_from = self.__get_from_redis(self.__gen_key('date_from'))
-        if date_from is not None:
-            self.date_from = datetime.datetime.strptime(
-                date_from.decode(),
-                SKYSCANNER_DATE_FORMAT,
-            ).date()
-
-        date_to = self.__get_from_redis(self.__gen_key('date_to'))
-        if date_to is not None:
-            self.date_to = datetime.datetime.strptime(
-                date_to.decode(),
-                SKYSCANNER_DATE_FORMAT,
-            ).date()
+        pipe = redis.pipeline(transaction=False)
+        self.queue_load(pipe)
+        with metrics.redis_session_seconds.time(operation='load'):
+            data, _ = pipe.execute()
+        self.load_fields(data)
 
     def clear(self):
-        keys = [
-            self.__gen_key(k)
-            for k in ['state', 'place_from', 'place_to',
-                      'date_from', 'date_to']
-        ]
-        redis.delete(*keys)
-        self.machine.set_state(UserStates.SELECT_COUNTRY_FROM.value)
+        redis.delete(self.key)
+        self.reset()
+
+    def reset(self):
+        self.state = self.machine.initial
         self.country_from = None
         self.place_from = None
         self.place_to = None
         self.date_from = None
         self.date_to = None
+        self.ticket = None
+        self.dirty.clear()
+
+
+class SessionManager:
+    """Bounded LRU of loaded sessions keyed by user id.
+
+    Sessions write through to redis on ``flush()``, so evicting one only
+    drops it from memory. Concurrent requests for the same user wait for
+    a single load.
+    """
+
+    def __init__(self, factory=User, size: int=SESSION_CACHE_SIZE):
+        self.factory = factory
+        self.size = size
+        self._sessions = collections.OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, user_id):
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is not None:
+                self._sessions.move_to_end(user_id)
+                metrics.session_cache_requests.inc(result='hit')
+                return session
+            loading = self._loading.setdefault(user_id, threading.Lock())
+
+        with loading:
+            with self._lock:
+                session = self._sessions.get(user_id)
+            if session is None:
+                metrics.session_cache_requests.inc(result='miss')
+                session = self.factory(user_id)
+                self.put(session)
+
+        with self._lock:
+            self._loading.pop(user_id, None)
+        return session
+
+    def put(self, session):
+        evicted = []
+        with self._lock:
+            self._sessions[session.user_id] = session
+            self._sessions.move_to_end(session.user_id)
+            while len(self._sessions) > self.size:
+                evicted.append(self._sessions.popitem(last=False)[1])
+
+        for session in evicted:
+            session.flush()
+
+    def discard(self, user_id):
+        with self._lock:
+            self._sessions.pop(user_id, None)
 
 
 class SkyscannerApi:
     def __init__(self, token: str=SKYSCANNER_TOKEN):
         self.token = token
+        self.client = HttpClient(
+            pool_size=SKYSCANNER_POOL_SIZE,
+            backoff=SKYSCANNER_RETRY_BACKOFF,
+            backoff_max=SKYSCANNER_RETRY_BACKOFF_MAX,
+            breaker_threshold=SKYSCANNER_BREAKER_THRESHOLD,
+            breaker_timeout=SKYSCANNER_BREAKER_TIMEOUT,
+        )
+        self.executor = ThreadPoolExecutor(SKYSCANNER_SEARCH_CONCURRENCY)
+        self.geo = GeoCatalog(self.get_all_geo, redis)
+        self.quotes = QuoteCache(redis)
+
+    @property
+    def short_token(self):
         # When you need to make a client-side call please insure that you use
         # your short API key (the first 16 characters of you key).
-        self.short_token = self.token[:16]
+        return (self.token or '')[:16]
 
-    def request(self,
-                url: str,
-                params: dict=None,
-                timeout: int=10,
-                attempts: int=3):
+    def prepare_request(self, url: str, params: dict=None):
         if params is None:
             params = {}
 
@@ -179,43 +364,63 @@ class SkyscannerApi:
         headers = {
             'Accept': 'application/json',
         }
-        for _ in range(attempts):
-            try:
-                return requests.get(
-                    url,
-                    headers=headers,
-                    params=params,
-                    timeout=timeout,
-                ).json()
-            except Exception as e:
-                raise e
+        endpoint = url[len(SKYSCANNER_API_URL):].strip('/').split('/')[0]
+        return endpoint, params, headers
 
-    def get_all_geo(self):
-        url = '{}/{}/{}'.format(
+    def request(self,
+                url: str,
+                params: dict=None,
+                timeout: int=10,
+                attempts: int=3):
+        endpoint, params, headers = self.prepare_request(url, params)
+        return self.client.get_json(
+            url,
+            endpoint,
+            params=params,
+            headers=headers,
+            timeout=timeout,
+            attempts=attempts,
+        )
+
+    @staticmethod
+    def geo_url():
+        return '{}/{}/{}'.format(
             SKYSCANNER_API_URL,
             'geo',
             SKYSCANNER_API_VERSION,
         )
-        return self.request(url, params={'languageid': SKYSCANNER_LOCALE})
 
-    def get_counties(self):
-        data = self.get_all_geo()
-        return (
-            Country(country['Name'], country['Id'])
-            for continents in data['Continents']
-            for country in continents['Countries']
+    def get_all_geo(self):
+        return self.request(self.geo_url(),
+                            params={'languageid': SKYSCANNER_LOCALE})
+
+    def open_geo(self, timeout: int=60):
+        """Streamed response of the geo tree, read from ``response.raw``."""
+        url = self.geo_url()
+        _, params, headers = self.prepare_request(
+            url, {'languageid': SKYSCANNER_LOCALE},
         )
+        response = self.client.session.get(
+            url,
+            headers=headers,
+            params=params,
+            timeout=timeout,
+            stream=True,
+        )
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return response
+
+    def get_counties(self):
+        return self.geo.get_countries()
 
     def get_cities(self):
-        data = self.get_all_geo()
-        return (
-            City(city['Name'], city['Id'])
-            for continent in data['Continents']
-            for country in continent['Countries']
-            for city in country['Cities']
-        )
+        return self.geo.get_cities()
 
-    def make_booking_url(self, u: User):
+    def make_booking_url(self,
+                         u: User,
+                         date_from: datetime.date=None,
+                         date_to: datetime.date=None):
         return '{}/{}/{}/{}/{}/{}/{}/{}/{}/{}?apiKey={}'.format(
             SKYSCANNER_API_URL,
             'referral',
@@ -225,53 +430,166 @@ class SkyscannerApi:
             SKYSCANNER_LOCALE,
             u.place_from,
             u.place_to,
-            u.date_from.strftime(SKYSCANNER_DATE_FORMAT),
-            u.date_to.strftime(SKYSCANNER_DATE_FORMAT),
+            (date_from or u.date_from).strftime(SKYSCANNER_DATE_FORMAT),
+            (date_to or u.date_to).strftime(SKYSCANNER_DATE_FORMAT),
             self.short_token,
         )
 
-    def search(self, u: User, attempts: int=3):
-        data = None
-        for _ in range(attempts):
-            try:
-                url = '{}/{}/{}/{}/{}/{}/{}/{}/{}/{}'.format(
-                    SKYSCANNER_API_URL,
-                    'browsequotes',
-                    SKYSCANNER_API_VERSION,
-                    u.country_from,
-                    SKYSCANNER_CURRENCY,
-                    SKYSCANNER_LOCALE,
-                    u.place_from,
-                    u.place_to,
-                    u.date_from.strftime(SKYSCANNER_DATE_FORMAT),
-                    u.date_to.strftime(SKYSCANNER_DATE_FORMAT),
-                )
-                data = self.request(url)
-                if data.get('Quotes', None) is None:
-                    raise SkyscannerApiNotFound
-                else:
-                    break
-
-            except SkyscannerApiNotFound:
-                u.date_from = u.date_from - datetime.timedelta(days=1)
-                u.date_to = u.date_to - datetime.timedelta(days=1)
-                continue
-            except Exception as e:
-                raise e
+    def make_search_url(self,
+                        u: User,
+                        date_from: datetime.date=None,
+                        date_to: datetime.date=None):
+        return '{}/{}/{}/{}/{}/{}/{}/{}/{}/{}'.format(
+            SKYSCANNER_API_URL,
+            'browsequotes',
+            SKYSCANNER_API_VERSION,
+            u.country_from,
+            SKYSCANNER_CURRENCY,
+            SKYSCANNER_LOCALE,
+            u.place_from,
+            u.place_to,
+            (date_from or u.date_from).strftime(SKYSCANNER_DATE_FORMAT),
+            (date_to or u.date_to).strftime(SKYSCANNER_DATE_FORMAT),
+        )
 
-        if data is None or not data.get('Quotes'):
+    def make_month_search_url(self,
+                              u: User,
+                              month: datetime.date,
+                              inbound_month: datetime.date):
+        return '{}/{}/{}/{}/{}/{}/{}/{}/{}/{}'.format(
+            SKYSCANNER_API_URL,
+            'browsequotes',
+            SKYSCANNER_API_VERSION,
+            u.country_from,
+            SKYSCANNER_CURRENCY,
+            SKYSCANNER_LOCALE,
+            u.place_from,
+            u.place_to,
+            month.strftime(SKYSCANNER_MONTH_FORMAT),
+            inbound_month.strftime(SKYSCANNER_MONTH_FORMAT),
+        )
+
+    @staticmethod
+    def search_windows(u: User, attempts: int):
+        """Requested dates first, then the same trip shifted back a day."""
+        return [
+            (u.date_from - datetime.timedelta(days=shift),
+             u.date_to - datetime.timedelta(days=shift))
+            for shift in range(attempts)
+        ]
+
+    def make_ticket(self, u: User, data: dict, date_from, date_to):
+        if not data.get('Quotes'):
             return
 
         ticket = Ticket(data)
-        ticket.url = self.make_booking_url(u)
+        # Quotes may not make a trip, e.g. every inbound leaves before
+        # the cheapest outbounds.
+        if not ticket.options:
+            return
+        ticket.url = self.make_booking_url(u, date_from, date_to)
+        return ticket
+
+    @staticmethod
+    def pick_cheapest(results: list):
+        """Cheapest ticket of the windows, earlier windows win ties.
+
+        ``results`` holds a ticket, None or the raised error per window;
+        errors only propagate when no window could be searched.
+        """
+        tickets = [r for r in results if isinstance(r, Ticket)]
+        if tickets:
+            return min(tickets, key=lambda ticket: ticket.price)
+
+        errors = [r for r in results if isinstance(r, Exception)]
+        if len(errors) == len(results):
+            raise errors[0]
+
+    def get_quotes(self, u: User, date_from, date_to):
+        url = self.make_search_url(u, date_from, date_to)
+        return self.quotes.get_or_fetch(url, lambda: self.request(url))
+
+    def search_window(self, u: User, date_from, date_to):
+        data = self.get_quotes(u, date_from, date_to)
+        return self.make_ticket(u, data, date_from, date_to)
+
+    @staticmethod
+    def pick_payloads(results: list):
+        """Payloads of the searched windows, errors as in pick_cheapest."""
+        errors = [r for r in results if isinstance(r, Exception)]
+        if errors and len(errors) == len(results):
+            raise errors[0]
+        return [r for r in results if isinstance(r, dict)]
+
+    def search_anywhere(self,
+                        u: User,
+                        attempts: int=3,
+                        deadline: float=ANYWHERE_DEADLINE):
+        """Cheapest destinations of the windows searched by ``deadline``."""
+        futures = [
+            self.executor.submit(self.get_quotes, u, date_from, date_to)
+            for date_from, date_to in self.search_windows(u, attempts)
+        ]
+        # The requested dates are always waited for, shifted windows
+        # only count when they are back in time.
+        done, _ = wait(futures, timeout=deadline)
+        results = []
+        for future in futures:
+            if future is not futures[0] and future not in done:
+                continue
+            try:
+                results.append(future.result())
+            except BaseSkyscannerApiException as e:
+                results.append(e)
+        return rank_destinations(self.pick_payloads(results))
+
+    def make_flexible_ticket(self, u: User, payloads: list, stay: int):
+        data = merge_quotes(payloads)
+        if not data['Quotes']:
+            return
+
+        ticket = Ticket()
+        ticket.fill_from_data(data)
+        ticket = PriceCalendar(ticket, u.date_from, stay).make_ticket(
+            since=datetime.date.today(),
+        )
+        if ticket:
+            ticket.url = self.make_booking_url(
+                u, ticket.outbound.date, ticket.inbound.date,
+            )
         return ticket
 
+    def search_month(self, u: User, inbound_month: datetime.date):
+        url = self.make_month_search_url(u, u.date_from, inbound_month)
+        return self.quotes.get_or_fetch(url, lambda: self.request(url))
 
-api = SkyscannerApi()
+    def search_flexible(self, u: User, stay: int):
+        """Cheapest ``stay`` day trips leaving in the month of date_from."""
+        futures = [
+            self.executor.submit(self.search_month, u, inbound_month)
+            for inbound_month in stay_months(u.date_from, stay)
+        ]
+        return self.make_flexible_ticket(
+            u, [future.result() for future in futures], stay,
+        )
+
+    def search(self, u: User, attempts: int=3):
+        futures = [
+            self.executor.submit(self.search_window, u, date_from, date_to)
+            for date_from, date_to in self.search_windows(u, attempts)
+        ]
 
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except BaseSkyscannerApiException as e:
+                results.append(e)
+        return self.pick_cheapest(results)
 
-def search_in_list(query: str, data: list):
-    return [x for x in data if query.lower() in x.name.lower()]
+
+api = Lazy(SkyscannerApi)
+sessions = SessionManager()
 
 
 class BaseModel(peewee.Model):
@@ -280,9 +598,14 @@ class BaseModel(peewee.Model):
 
 
 class BotUser(BaseModel):
-    uid = peewee.CharField()
+    uid = peewee.CharField(unique=True)
 
 
 class Channel(BaseModel):
     user = peewee.ForeignKeyField(BotUser, backref='channels')
     uid = peewee.CharField()
+
+    class Meta:
+        indexes = (
+            (('user', 'uid'), True),
+        )
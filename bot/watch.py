@@ -0,0 +1,177 @@
+"""Price watches of found routes.
+
+Subscribers are grouped by route, the scheduler searches every watched
+route once per ``WATCH_INTERVAL`` no matter how many users watch it and
+notifies the subscribers whose threshold the price fell below. The
+threshold then follows the price, so only further drops are reported.
+"""
+import json
+import time
+import datetime
+import logging
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from .constants import SKYSCANNER_DATE_FORMAT, WATCH_INTERVAL, \
+    WATCH_CONCURRENCY
+from .errors import BaseSkyscannerApiException
+
+
+logger = logging.getLogger(__name__)
+
+# Has the attributes of ``User`` the search urls are made of.
+Route = collections.namedtuple(
+    'Route', 'country_from place_from place_to date_from date_to',
+)
+
+
+def make_route(u):
+    return Route(u.country_from, u.place_from, u.place_to,
+                 u.date_from, u.date_to)
+
+
+def dump_route(route: Route):
+    return ':'.join([
+        route.country_from,
+        route.place_from,
+        route.place_to,
+        route.date_from.strftime(SKYSCANNER_DATE_FORMAT),
+        route.date_to.strftime(SKYSCANNER_DATE_FORMAT),
+    ])
+
+
+def load_route(key: str):
+    country_from, place_from, place_to, date_from, date_to = key.split(':')
+    return Route(
+        country_from,
+        place_from,
+        place_to,
+        datetime.datetime.strptime(date_from, SKYSCANNER_DATE_FORMAT).date(),
+        datetime.datetime.strptime(date_to, SKYSCANNER_DATE_FORMAT).date(),
+    )
+
+
+class PriceWatcher:
+    routes_key = 'watch_routes'
+    lock_key = 'watch_lock'
+    retry_interval = 60
+
+    def __init__(self,
+                 api,
+                 redis,
+                 notify,
+                 interval: int=WATCH_INTERVAL,
+                 concurrency: int=WATCH_CONCURRENCY):
+        self.api = api
+        self.redis = redis
+        self.notify = notify
+        self.interval = interval
+        self.executor = ThreadPoolExecutor(concurrency)
+
+    @staticmethod
+    def subscribers_key(route_key: str):
+        return 'watch_route_{}'.format(route_key)
+
+    @staticmethod
+    def user_key(user_id):
+        return 'watch_user_{}'.format(user_id)
+
+    def watch(self, route: Route, user_id, chat_id, threshold):
+        route_key = dump_route(route)
+        pipe = self.redis.pipeline(transaction=False)
+        subscriber = json.dumps({'chat_id': chat_id, 'threshold': threshold})
+        pipe.hset(self.subscribers_key(route_key), str(user_id), subscriber)
+        pipe.sadd(self.user_key(user_id), route_key)
+        pipe.sadd(self.routes_key, route_key)
+        pipe.execute()
+
+    def unwatch(self, user_id):
+        """Drop all watches of the user, return how many there were."""
+        route_keys = self.redis.smembers(self.user_key(user_id))
+        pipe = self.redis.pipeline(transaction=False)
+        for route_key in route_keys:
+            pipe.hdel(self.subscribers_key(route_key.decode()), str(user_id))
+        pipe.delete(self.user_key(user_id))
+        pipe.execute()
+        return len(route_keys)
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run(self):
+        while True:
+            try:
+                # The lock outlives the round, so every process may try
+                # and only one of them checks the routes per interval.
+                if self.redis.set(self.lock_key, 1, nx=True,
+                                  ex=self.interval):
+                    self.check()
+                self.wait()
+            except Exception:
+                logger.exception('Failed to check watched prices')
+                time.sleep(min(self.retry_interval, self.interval))
+
+    def wait(self):
+        ttl = self.redis.ttl(self.lock_key)
+        time.sleep(ttl if ttl and ttl > 0 else self.interval)
+
+    def check(self):
+        today = datetime.date.today()
+        routes = []
+        for route_key in self.redis.smembers(self.routes_key):
+            route_key = route_key.decode()
+            route = load_route(route_key)
+            if route.date_from < today:
+                self.drop(route_key)
+            else:
+                routes.append((route_key, route))
+
+        list(self.executor.map(lambda item: self.check_route(*item), routes))
+
+    def drop(self, route_key: str):
+        subscribers_key = self.subscribers_key(route_key)
+        user_ids = self.redis.hkeys(subscribers_key)
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.srem(self.user_key(user_id.decode()), route_key)
+        pipe.delete(subscribers_key)
+        pipe.srem(self.routes_key, route_key)
+        pipe.execute()
+
+    def check_route(self, route_key: str, route: Route):
+        """Check one route, its errors do not stop the others."""
+        try:
+            self.notify_subscribers(route_key, route)
+        except BaseSkyscannerApiException:
+            logger.warning('Failed to check %s', route_key)
+        except Exception:
+            logger.exception('Failed to check %s', route_key)
+
+    def notify_subscribers(self, route_key: str, route: Route):
+        subscribers_key = self.subscribers_key(route_key)
+        subscribers = self.redis.hgetall(subscribers_key)
+        if not subscribers:
+            self.redis.srem(self.routes_key, route_key)
+            return
+
+        ticket = self.api.search_window(route, route.date_from,
+                                        route.date_to)
+        if ticket is None:
+            return
+
+        for user_id, raw in subscribers.items():
+            subscriber = json.loads(raw.decode())
+            if ticket.price >= subscriber['threshold']:
+                continue
+
+            try:
+                self.notify(subscriber['chat_id'], ticket)
+            except Exception:
+                logger.exception('Failed to notify %s', user_id)
+                continue
+            subscriber['threshold'] = ticket.price
+            self.redis.hset(subscribers_key, user_id, json.dumps(subscriber))
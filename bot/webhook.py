@@ -0,0 +1,155 @@
+"""Webhook execution mode of the bot.
+
+A small http server receives updates from Telegram and hands them to a
+pool of worker threads. Updates are sharded by user, so each user's
+updates are processed in order by one worker while different users are
+processed in parallel.
+
+    python -m bot.webhook
+"""
+import queue
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot import types
+
+from bot import metrics
+from bot.constants import TOKEN, WEBHOOK_URL, WEBHOOK_PORT, \
+    WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE
+
+
+logger = logging.getLogger(__name__)
+
+UPDATE_KINDS = ('message', 'edited_message', 'channel_post',
+                'edited_channel_post', 'inline_query',
+                'chosen_inline_result', 'callback_query')
+
+
+def get_shard_key(update):
+    """User id of the update, chat id for channel posts."""
+    for kind in UPDATE_KINDS:
+        obj = getattr(update, kind, None)
+        if obj is None:
+            continue
+        if getattr(obj, 'from_user', None) is not None:
+            return obj.from_user.id
+        if getattr(obj, 'chat', None) is not None:
+            return obj.chat.id
+    return 0
+
+
+class UpdatePipeline:
+    """Bounded per-worker queues, updates of a user go to one worker."""
+
+    def __init__(self,
+                 process,
+                 workers: int=WEBHOOK_WORKERS,
+                 queue_size: int=WEBHOOK_QUEUE_SIZE):
+        self.process = process
+        self.queues = [queue.Queue(queue_size) for _ in range(workers)]
+        self.threads = []
+
+    def start(self):
+        for q in self.queues:
+            thread = threading.Thread(target=self.work, args=(q,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, update, raw: str=None):
+        """Queue the update, return False when its worker is saturated."""
+        q = self.queues[hash(get_shard_key(update)) % len(self.queues)]
+        try:
+            q.put_nowait(update)
+        except queue.Full:
+            return False
+        return True
+
+    def work(self, q):
+        while True:
+            update = q.get()
+            try:
+                self.process(update)
+            except Exception:
+                logger.exception('Failed to process update %s',
+                                 update.update_id)
+            finally:
+                q.task_done()
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            return self.reply(200, metrics.exposition().encode(),
+                              metrics.CONTENT_TYPE)
+        if self.path == '/ready':
+            return self.reply(200 if self.server.ready.is_set() else 503)
+        self.reply(404)
+
+    def do_POST(self):
+        if self.path != '/{}'.format(TOKEN):
+            return self.reply(404)
+
+        length = int(self.headers.get('Content-Length', 0))
+        raw = self.rfile.read(length).decode()
+        try:
+            update = types.Update.de_json(raw)
+        except ValueError:
+            return self.reply(400)
+
+        # Telegram redelivers updates answered with an error, so a full
+        # queue pushes back instead of dropping the update.
+        if not self.server.pipeline.submit(update, raw):
+            return self.reply(503)
+        self.reply(200)
+
+    def reply(self, status: int, body: bytes=b'',
+              content_type: str='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, pipeline, ready):
+        super().__init__(address, WebhookHandler)
+        self.pipeline = pipeline
+        self.ready = ready
+
+
+def serve(bot, pipeline, ready):
+    """Serve the webhook, /ready answers 200 once ``ready`` is set."""
+    bot.remove_webhook()
+    bot.set_webhook(url='{}/{}'.format(WEBHOOK_URL.rstrip('/'), TOKEN))
+
+    server = WebhookServer(('', WEBHOOK_PORT), pipeline, ready)
+    logger.info('Listening for webhooks on port %s', WEBHOOK_PORT)
+    server.serve_forever()
+
+
+def run():
+    from bot.app import create_app
+    from bot.main import bot, watcher
+    from bot.writes import writes
+
+    # Handlers run in the pipeline workers, not in telebot's own pool,
+    # otherwise the per-user ordering would be lost.
+    bot.threaded = False
+    pipeline = UpdatePipeline(lambda u: bot.process_new_updates([u]))
+    pipeline.start()
+
+    app = create_app(bot=bot, services=[writes, watcher]).start()
+    serve(bot, pipeline, app.ready)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    run()
@@ -0,0 +1,187 @@
+"""Write-behind of user registrations and channel changes.
+
+Handlers answer as soon as a change is queued in redis. A background
+thread moves queued changes to a processing list and applies them to
+Postgres in one transaction per batch, when ``WRITE_BATCH_SIZE`` changes
+are waiting or every ``WRITE_FLUSH_INTERVAL`` seconds. A batch is removed
+from the processing list only after its commit, batches left there by a
+crashed process are applied again, changes are idempotent.
+
+The processing list belongs to the holder of a lock, and is changed only
+in transactions checking the lock is still held. A flush outliving the
+lock stops and leaves its batch to the next holder.
+"""
+import json
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+
+from redis import WatchError
+
+from .constants import WRITE_QUEUE_KEY, WRITE_BATCH_SIZE, \
+    WRITE_FLUSH_INTERVAL, WRITE_LOCK_TIMEOUT, BOT_USERS_KEY
+from .utils import redis, db, db_connection, BotUser, Channel
+
+
+logger = logging.getLogger(__name__)
+
+
+class LockLost(Exception):
+    pass
+
+
+class WriteBehind:
+    def __init__(self,
+                 redis,
+                 key: str=WRITE_QUEUE_KEY,
+                 batch_size: int=WRITE_BATCH_SIZE,
+                 interval: float=WRITE_FLUSH_INTERVAL):
+        self.redis = redis
+        self.key = key
+        self.processing_key = '{}_processing'.format(key)
+        self.lock_key = '{}_lock'.format(key)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.wake = threading.Event()
+
+    def push(self, change: dict):
+        if self.redis.lpush(self.key, json.dumps(change)) >= self.batch_size:
+            self.wake.set()
+
+    def add_user(self, uid):
+        """Register the user, only users new to redis reach the queue."""
+        if self.redis.sismember(BOT_USERS_KEY, str(uid)):
+            return
+
+        # Marked and queued together, a user is never marked without
+        # being written. Concurrent registrations queue it twice at most.
+        pipe = self.redis.pipeline()
+        pipe.sadd(BOT_USERS_KEY, str(uid))
+        pipe.lpush(self.key, json.dumps({'op': 'add_user', 'uid': str(uid)}))
+        if pipe.execute()[1] >= self.batch_size:
+            self.wake.set()
+
+    def add_channel(self, uid, name: str):
+        self.push({'op': 'add_channel', 'uid': str(uid), 'name': name})
+
+    def delete_channel(self, uid, name: str):
+        self.push({'op': 'delete_channel', 'uid': str(uid), 'name': name})
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to flush %s', self.key)
+
+    def flush(self):
+        # One flusher at a time owns the processing list.
+        token = uuid.uuid4().hex.encode()
+        if not self.redis.set(self.lock_key, token, nx=True,
+                              ex=WRITE_LOCK_TIMEOUT):
+            return
+
+        try:
+            pending = self.redis.lrange(self.processing_key, 0, -1)
+            if pending:
+                self.apply_batch(token, pending[::-1])
+
+            while True:
+                batch = self.take_batch(token)
+                if not batch:
+                    break
+                self.apply_batch(token, batch)
+                if len(batch) < self.batch_size:
+                    break
+        except LockLost:
+            logger.warning('Lost the lock of %s, the batch is applied again',
+                           self.key)
+        finally:
+            self.release(token)
+
+    def locked(self, token: bytes, command):
+        """Run ``command`` on a transaction if the lock is ``token``'s."""
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(self.lock_key)
+                if pipe.get(self.lock_key) != token:
+                    raise LockLost
+                pipe.multi()
+                command(pipe)
+                return pipe.execute()
+            except WatchError:
+                raise LockLost
+
+    def release(self, token: bytes):
+        try:
+            self.locked(token, lambda pipe: pipe.delete(self.lock_key))
+        except LockLost:
+            pass
+
+    def take_batch(self, token: bytes):
+        def take(pipe):
+            for _ in range(self.batch_size):
+                pipe.rpoplpush(self.key, self.processing_key)
+            # Every batch extends the lock.
+            pipe.expire(self.lock_key, WRITE_LOCK_TIMEOUT)
+
+        moved = self.locked(token, take)[:-1]
+        return [item for item in moved if item is not None]
+
+    def apply_batch(self, token: bytes, batch):
+        users = set()
+        # Only the last change of a channel matters, they are idempotent.
+        channels = OrderedDict()
+        for raw in batch:
+            change = json.loads(raw.decode())
+            if change['op'] == 'add_user':
+                users.add(change['uid'])
+            else:
+                channels[change['uid'], change['name']] = change['op']
+
+        with db_connection():
+            with db.atomic():
+                self.apply(users, channels)
+        self.locked(token, lambda pipe: pipe.delete(self.processing_key))
+
+    @staticmethod
+    def apply(users, channels):
+        if users:
+            BotUser.insert_many(
+                [{'uid': uid} for uid in users],
+            ).on_conflict_ignore().execute()
+
+        if not channels:
+            return
+
+        user_ids = dict(
+            BotUser.select(BotUser.uid, BotUser.id)
+            .where(BotUser.uid.in_({uid for uid, _ in channels}))
+            .tuples()
+        )
+        added = []
+        for (uid, name), op in channels.items():
+            user_id = user_ids.get(uid)
+            if user_id is None:
+                logger.warning('Dropped %s of %s, no user %s', op, name, uid)
+            elif op == 'add_channel':
+                added.append({'user': user_id, 'uid': name})
+            else:
+                Channel.delete().where(
+                    Channel.user == user_id,
+                    Channel.uid == name,
+                ).execute()
+        if added:
+            Channel.insert_many(added).on_conflict_ignore().execute()
+
+
+writes = WriteBehind(redis)